@@ -1,27 +1,101 @@
-from GenericClass.Task import CommandTask
-
-
 import re
 import os
-import sh
-import pip
 import sys
 import copy
-import psutil
-import pkgutil
+import json
+import time
+import struct
+import socket
+import ipaddress
+import shlex
+import signal
+import shutil
+import textwrap
+import fnmatch
+import functools
+import hashlib
 import argparse
+import contextlib
+import itertools
+import threading
 import subprocess
 from enum import Enum
 from tempfile import NamedTemporaryFile
-from nginx.config.api.options import KeyValuesMultiLines
-from nginx.config.api import Section, Location, KeyValueOption, KeyOption
+from django_run_helper import parse_managed_block, CADDY_CONFIG_FILE, CADDY_FRAGMENT_DIR, NGINX_CONFIG_FILE, NGINX_FRAGMENT_DIR
 
 
 BASE_PORT = '8000'
-ANCHOR_START = """### START AUTO MANAGE ###"""
-ANCHOR_STOP = """### STOP AUTO MANAGE ###"""
 
-IPS = ['127.0.0.{}'.format(i) for i in range(2, 250)]
+DEFAULT_IP_RANGES = ['127.0.0.2-127.0.0.249']
+RESERVATION_TTL = 120
+
+STATE_DIR = os.path.join(os.getenv("HOME"), ".cache", "django-run")
+PID_REGISTRY_FILE = os.path.join(STATE_DIR, "pids.json")
+HOST_OPTIONS_FILE = os.path.join(STATE_DIR, "hosts.json")
+PRE_RUN_CACHE_FILE = os.path.join(STATE_DIR, "pre-run-cache.json")
+LOG_DIR = os.path.join(STATE_DIR, "logs")
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+LOG_TAIL_LINES = 20
+LOG_POLL_INTERVAL = 0.25
+LAZY_PORT_OFFSET = 1000
+LAZY_IDLE_TIMEOUT = 15
+LAZY_IDLE_CHECK = 10
+RELOAD_DEBOUNCE = 0.5
+RELOAD_PATTERNS = ['*.py', '*.mo']
+INOTIFY_MASK = 0x8 | 0x40 | 0x80 | 0x100 | 0x200  # CLOSE_WRITE, MOVED_FROM, MOVED_TO, CREATE, DELETE
+INOTIFY_CREATED = 0x80 | 0x100
+INOTIFY_OVERFLOW = 0x4000
+INOTIFY_IGNORED = 0x8000
+INOTIFY_ISDIR = 0x40000000
+TOP_INTERVAL = 2
+TOP_RESCAN_EVERY = 10
+BENCH_CONCURRENCY = 10
+BENCH_DURATION = 10
+BENCH_ERROR_BACKOFF = 0.05
+BENCH_REQUEST_TIMEOUT = 5
+STATE_DB = os.path.join(STATE_DIR, "state.sqlite3")
+STATE_DB_TIMEOUT = 30
+STATE_VERSION = 2
+DNS_BIND = '127.0.0.250'
+DNS_PORT = 10053
+# Port 53 would need root, and under sudo $HOME (so the state store) is root's, not the user's
+DNS_RESOLVER_HINT = (
+    "Point the system resolver at it for .{extension}, e.g. 'DNS={bind}:{port}' and 'Domains=~{extension}' "
+    "in /etc/systemd/resolved.conf, or 'server=/{extension}/{bind}#{port}' for dnsmasq"
+)
+DNS_TTL = 5
+DAEMON_SOCKET = os.path.join(STATE_DIR, "daemon.sock")
+DAEMON_TIMEOUT = 60
+# Options the daemon's answers depend on, a client with other values runs locally
+DAEMON_OPTIONS = ['use_nginx', 'ip_range', 'caddy_admin', 'extension']
+PROCESS_INDEX_TTL = 2
+FRAGMENT_HASH_MARKER = "# django-run hash: "
+HELPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "django_run_helper.py")
+MANAGEPY_CACHE_FILE = os.path.join(STATE_DIR, "managepy-cache.json")
+MANAGEPY_SEARCH_DEPTH = 1
+MANAGEPY_IGNORE = ['.*', 'node_modules', 'venv', 'env', '__pycache__', 'media', 'static', 'staticfiles', 'build', 'dist']
+STATIC_SETTINGS_TIMEOUT = 60
+STATIC_SETTINGS_SCRIPT = (
+    "import json; from django.conf import settings; "
+    "print(json.dumps([[settings.STATIC_URL, str(settings.STATIC_ROOT or '')], [settings.MEDIA_URL, str(settings.MEDIA_ROOT or '')]]))"
+)
+READINESS_TIMEOUT = 60
+READINESS_INITIAL_DELAY = 0.05
+READINESS_MAX_DELAY = 2
+STACK_SHUTDOWN_TIMEOUT = 10
+STACK_MANIFEST_EXAMPLE = """
+[[service]]
+name = "gestion"                                  # served on gestion.{extension}
+path = "~/Documents/work/gestion"                 # manage.py is searched there
+python = "~/miniconda3/envs/gestion/bin/python"   # default: python from PATH
+args = ["--nothreading"]                          # extra runserver arguments
+workers = 1                                       # runserver processes behind the proxy
+celery = true                                     # also start a celery worker
+"""
+STARTUP_HISTORY_FILE = os.path.join(STATE_DIR, "startup-history.jsonl")
+STARTUP_BENCH_FILE = os.path.join(STATE_DIR, "startup-bench.jsonl")
+STARTUP_BENCH_COMMANDS = [['--help'], ['--config'], ['--config', '--use-nginx'], ['--managed']]
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--no-open', action="store_true")
@@ -43,30 +117,154 @@ parser.add_argument('--sls', action="store_true", help=("Generate SLS command fo
 parser.add_argument('--use-tmux-window-name', action="store_true", help=("Use the tmux window name for the name, instead of the env/project name"))
 parser.add_argument('--use-nginx', action="store_true", help=("Use old nginx reverse proxy [DEPRECATED in favor of Caddy]"))
 parser.add_argument('--use-ssl', action="store_true", help=("Use ssl for django webserver (using runserver_plus --cert-file cert.crt) [DEPRECATED in favor of Caddy]"))
+parser.add_argument('--caddy-admin', type=str, default='http://localhost:2019', help=("Caddy admin API endpoint used to hot reload the config, on a loopback address, default 'http://localhost:2019'"))
+parser.add_argument('--ip-range', action="append", help=("IP pool used for new hosts, as 'first-last' or CIDR, can be repeated, default 127.0.0.2-127.0.0.249"))
+parser.add_argument('--daemon', action="store_true", help=("Run the django-run daemon, holding managed hosts, running servers and proxy state in memory"))
+parser.add_argument('--no-daemon', action="store_true", help=("Don't go through the django-run daemon even if it is running"))
+parser.add_argument('--startup-bench', action="store_true", help=("Measure cold start and import time (python -X importtime) of the main subcommands"))
+parser.add_argument('--stack', type=str, help=("Launch every service of a TOML manifest at once (see STACK_MANIFEST_EXAMPLE)"))
+parser.add_argument('--ready-timeout', type=float, default=READINESS_TIMEOUT, help=("Seconds to wait for a server to answer before giving up on opening it, default {}".format(READINESS_TIMEOUT)))
+parser.add_argument('--stats', action="store_true", help=("Show per project startup time percentiles, for each phase of a launch"))
+parser.add_argument('--search-depth', type=int, default=MANAGEPY_SEARCH_DEPTH, help=("How many directory levels below the current one to search for manage.py, default {}".format(MANAGEPY_SEARCH_DEPTH)))
+parser.add_argument('--search-ignore', action="append", default=[], help=("Directory name pattern to skip while searching manage.py, can be repeated (added to {})".format(', '.join(MANAGEPY_IGNORE))))
+parser.add_argument('--workers', type=int, help=("Number of runserver processes behind the proxy for this host, on consecutive ports from {}, remembered per host, default 1".format(BASE_PORT)))
+parser.add_argument('--celery-workers', type=int, default=1, help=("Number of celery workers started with --celery, default 1"))
+parser.add_argument('--celery-concurrency', type=int, help=("Concurrency of each celery worker (celery default: number of CPUs)"))
+parser.add_argument('--celery-pool', choices=['prefork', 'threads', 'gevent', 'eventlet', 'solo'], help=("Celery worker pool implementation"))
+parser.add_argument('--celery-app', type=str, default='app', help=("Celery application passed to -A, default 'app'"))
+parser.add_argument('--no-celery-beat', action="store_true", help=("Don't start celery beat with --celery (at most one beat runs per project anyway)"))
+parser.add_argument('--pre-run', action="append", default=[], help=("Command to run before the server starts, in parallel with the other pre-run commands, can be repeated"))
+parser.add_argument('--pre-run-background', action="append", default=[], help=("Like --pre-run, but the server does not wait for it to finish"))
+parser.add_argument('--no-pre-run-cache', action="store_true", help=("Run pre-run commands even if migrations, settings and git HEAD did not change since their last success"))
+parser.add_argument('--json', action="store_true", help=("Machine readable output for --managed (joined status of every host) and --config"))
+parser.add_argument('--certs', action="store_true", help=("Show the certificate of every managed host and when it expires"))
+parser.add_argument('--generate-certs', action="store_true", help=("Generate the missing or expiring certificates of all managed hosts from a local CA (needs the 'cryptography' package)"))
+parser.add_argument('--logs', nargs="+", type=str, help=("Follow the logs of one or more managed hosts, interleaved and prefixed"))
+parser.add_argument('--top', action="store_true", help=("Live CPU, memory, file descriptors and threads of every managed server and its celery processes"))
+parser.add_argument('--top-interval', type=float, default=TOP_INTERVAL, help=("Seconds between two --top samples, default {}".format(TOP_INTERVAL)))
+parser.add_argument('--top-sort', choices=['cpu', 'rss', 'fds', 'threads', 'host'], default='cpu', help=("Column --top is sorted by, default cpu"))
+parser.add_argument('--idle-stop', type=float, help=("With --top, stop servers whose host got no request for that many minutes"))
+parser.add_argument('--bench', type=str, help=("Load test a managed host for --bench-duration seconds, directly on ip:{} and through the proxy, and report throughput and latency percentiles".format(BASE_PORT)))
+parser.add_argument('--bench-path', type=str, default='/', help=("Path requested by --bench, default '/'"))
+parser.add_argument('--bench-concurrency', type=int, default=BENCH_CONCURRENCY, help=("Concurrent connections used by --bench, default {}".format(BENCH_CONCURRENCY)))
+parser.add_argument('--bench-duration', type=float, default=BENCH_DURATION, help=("Seconds each --bench run lasts, default {}".format(BENCH_DURATION)))
+parser.add_argument('--bench-no-keep-alive', action="store_true", help=("Open a new connection for every --bench request"))
+parser.add_argument('--bench-target', choices=['both', 'direct', 'proxy'], default='both', help=("Which path --bench measures, default both to show the proxy overhead"))
+parser.add_argument('--lazy', action="store_true", help=("Hold the host's ip:{} with a light listener and only start runserver on the first connection".format(BASE_PORT)))
+parser.add_argument('--idle-timeout', type=float, default=LAZY_IDLE_TIMEOUT, help=("With --lazy, stop runserver after that many minutes without traffic, default {}".format(LAZY_IDLE_TIMEOUT)))
+parser.add_argument('--static-proxy', action=argparse.BooleanOptionalAction, help=("Have the proxy serve STATIC_URL and MEDIA_URL from STATIC_ROOT and MEDIA_ROOT instead of runserver, remembered per host. Off by default, since collected files go stale while editing app static files"))
+parser.add_argument('--inotify-reload', action="store_true", help=("Restart runserver from one shared inotify watcher, debounced over {}s, instead of Django's per-process stat polling".format(RELOAD_DEBOUNCE)))
+parser.add_argument('--wildcard', action=argparse.BooleanOptionalAction, help=("Also answer the subdomains of the host one label deep (tenant.HOST), through --dns and the proxy, remembered per host"))
+parser.add_argument('--dns', action="store_true", help=("Run a DNS responder answering the managed hosts (and wildcards) of the state store from memory"))
+parser.add_argument('--dns-bind', type=str, default=DNS_BIND, help=("Address the --dns responder listens on, default {}".format(DNS_BIND)))
+parser.add_argument('--dns-port', type=int, default=DNS_PORT, help=("UDP port the --dns responder listens on, default {}. Run it as your user: port 53 needs 'sudo setcap cap_net_bind_service=+ep' on the python binary, not sudo".format(DNS_PORT)))
+parser.add_argument('--hosts-file', choices=['on', 'off'], help=("Keep writing managed hosts to /etc/hosts ('on', default) or leave them to the --dns responder ('off'), which the system resolver must then query for .EXTENSION names"))
+parser.add_argument('--caddy-tls', choices=['on', 'off'], help=("Have Caddy serve the certificates of CERT_KEY_DEFAULT_PATH ('on') or its own internal ones ('off', default). The caddy user must be able to read the keys, e.g. chgrp caddy KEY && chmod 0640 KEY"))
+parser.add_argument('--relaunch', type=str, help=("Launch a managed host again from its project folder, with the interpreter and options it was last started with"))
+parser.add_argument('--import-hosts', action="store_true", help=("Replace the managed hosts of the state store with the managed block of /etc/hosts"))
 parser.add_argument('--extension', type=str, default='local', help=("Domain name extensions, default 'local'"))
 parser.add_argument('--with-debug', '-d', action="store_true", help=("Attach debugger debugpy to the runserver"))
 parser.add_argument('--no-wait-for-client', '-nw', action="store_true", help=("Don't pass the --wait-for-client argument to the debugger"))
 
-args, uargs = parser.parse_known_args()
+# Parsed in __main__, so importing this module stays cheap
+args, uargs = None, []
 
 CERT_KEY_DEFAULT_PATH = "/home/legrems/Documents/django-certificates/"
+CERT_CA_NAME = "django-run-ca"
+CERT_VALIDITY_DAYS = 825
+CERT_EXPIRY_WARNING_DAYS = 30
+
+SERVER_NAME_FORMAT = "{}.local"
+
+
+class FirefoxAsyncLaunch(threading.Thread):
+
+    def __init__(self, host, ip, open_browser=True, record=False):
+        super().__init__(daemon=True)
+        self.host = host
+        self.ip = ip
+        self.open_browser = open_browser
+        self.record = record
+
+    def run(self):
+        import sh
+
+        timings = {}
+        if wait_until_ready(self.ip, self.host, timings=timings) is None:
+            return
+
+        # Only a server started by this launch has a startup time worth recording
+        if self.record:
+            PHASE_TIMINGS.update(timings)
+            record_startup(self.host)
+
+        if self.open_browser:
+            sh.firefox(proxy_url(self.host))
+
+
+class CeleryPool:
+
+    def __init__(self, endpoint, workers=1, concurrency=None, pool=None, app='app', beat=True):
+        self.endpoint = endpoint
+        self.workers = workers
+        self.concurrency = concurrency
+        self.pool = pool
+        self.app = app
+        self.beat = beat
+        self.processes = {}
+
+    def worker_command(self, number):
+        worker_name = "worker-{}-{}@%h".format(self.endpoint.replace(SERVER_NAME_FORMAT.format(''), ''), number)
+        command = ["celery", "-A", self.app, "worker", "-l", "info", "-E", "-n", worker_name]
+
+        if self.pool:
+            command.extend(["--pool", self.pool])
+
+        if self.concurrency:
+            command.extend(["--concurrency", str(self.concurrency)])
 
-SERVER_NAME_FORMAT = f"{{}}.{args.extension}"
+        return command
 
-class FirefoxAsyncLaunch(CommandTask):
+    def spawn(self, key, kind, command):
+        # Own process group, so stopping a worker also stops its pool children
+        try:
+            process = spawn_logged(command, '{}.{}'.format(self.endpoint, kind), start_new_session=True)
 
-    def function(self, endpoint, time=2, *args, **kwargs):
-        time.sleep(time)
-        sh.firefox(endpoint)
+        except OSError as error:
+            pprint("Cannot start celery {} for {} ({}), going on without it".format(kind, self.endpoint, error), Mode.WARNING)
+            return False
 
+        register_process(key, process.pid, kind=kind, host=self.endpoint, command=' '.join(command))
+        self.processes[key] = process
+        return True
 
-class CeleryWorker(CommandTask):
+    def start(self):
+        for number in range(1, self.workers + 1):
+            pprint("Launching celery worker {}/{} for {}".format(number, self.workers, self.endpoint))
+            if not self.spawn('celery:{}:{}'.format(self.endpoint, number), 'celery', self.worker_command(number)):
+                return
 
-    def function(self, endpoint, *args, **kwargs):
-        command_string = "celery -A app worker -l info -B -E -n {}"
-        worker_name = "worker-{}".format(endpoint.replace(f".{args.extension}", ""))
-        pprint("Launching celery with worker name {}".format(worker_name))
-        subprocess.Popen(command_string.format(worker_name).split(" "), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not self.beat:
+            return
+
+        beat_key = 'beat:{}'.format(self.endpoint)
+        beat = get_registered_process(beat_key)
+        if beat and is_registered_alive(beat):
+            pprint("Celery beat already running for {}, not starting another one".format(self.endpoint), Mode.INFO)
+            return
+
+        pprint("Launching celery beat for {}".format(self.endpoint))
+        self.spawn(beat_key, 'beat', ["celery", "-A", self.app, "beat", "-l", "info"])
+
+    def stop(self):
+        for key, process in self.processes.items():
+            if process.poll() is None:
+                pprint("Stopping {}".format(key), Mode.OPERATION)
+                signal_process_group(process, signal.SIGTERM)
+
+        for key, process in self.processes.items():
+            process.wait()
+            unregister_process(key, process.pid)
 
 
 class Mode(Enum):
@@ -109,536 +307,3419 @@ def pprint(text, mode=Mode.OK, end='\n', continuous=False):
         print(to_write, end=end)
 
 
-def get_active_djangos(get_name=False):
+_process_index = None
 
-    active_djangos = []
-    for proc in psutil.process_iter(['cmdline']):
 
-        cmdline = ' '.join(proc.info['cmdline'])
-        if 'manage.py runserver' in cmdline and "bin/python" in cmdline:
-            django_ip = proc.info['cmdline'][-1]
+PHASE_TIMINGS = {}
+RUN_START = time.perf_counter()
 
-            if get_name:
-                short_location = proc.info['cmdline'][0].replace(os.path.join(os.getenv("HOME"), 'miniconda3/envs/'), '').replace('/bin/python', '')
-                active_djangos.append({'ip': django_ip, 'location': short_location})
 
-            else:
-                active_djangos.append(django_ip)
+@contextlib.contextmanager
+def timed_phase(name):
+    start = time.perf_counter()
 
-    return active_djangos
+    try:
+        yield
 
+    finally:
+        PHASE_TIMINGS[name] = PHASE_TIMINGS.get(name, 0) + time.perf_counter() - start
 
-def get_managed_host():
 
-    def all_etc_host():
-        with open('/etc/hosts', 'r') as etc:
-            return etc.read()
+def record_startup(project):
+    entry = {
+        'time': time.time(),
+        'project': project,
+        'phases': {name: round(duration, 4) for name, duration in PHASE_TIMINGS.items()},
+        'total': round(time.perf_counter() - RUN_START, 4),
+    }
 
-    managed_host = {}
-    managed = False
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(STARTUP_HISTORY_FILE, 'a') as history:
+        history.write(json.dumps(entry) + '\n')
 
-    for line in all_etc_host().split('\n'):
 
-        if managed and line != ANCHOR_STOP:
-            try:
-                ip, name = line.split('\t')
-                managed_host[name] = ip
-            except Exception:
-                pass
+def percentile(values, rank):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(rank / 100 * (len(ordered) - 1))))]
 
-        if line == ANCHOR_START:
-            managed = True
 
-        if line == ANCHOR_STOP:
-            managed = False
+def short_location(python_path):
+    return python_path.replace(os.path.join(os.getenv("HOME"), 'miniconda3/envs/'), '').replace('/bin/python', '')
 
-    return managed_host
 
+def runserver_bind(cmdline):
+    if 'runserver' in cmdline:
+        position = cmdline.index('runserver') + 1
+        if position < len(cmdline) and not cmdline[position].startswith('-'):
+            return cmdline[position]
 
-def update_managed_host(hosts):
-    middle = '\\n'.join(['{}\t{}'.format(v, k) for k, v in hosts.items()])
-    replaced = '{}\\n{}\\n{}'.format(ANCHOR_START, middle, ANCHOR_STOP)
-    sed_command = ["sudo", "sed", "-i", "-n", "/{}/{{:a;N;/{}/!ba;N;s/.*\\n/{}\\n/}};p".format(ANCHOR_START, ANCHOR_STOP, replaced), "/etc/hosts"]
+    return cmdline[-1]
 
-    subprocess.Popen(sed_command, stdout=subprocess.PIPE)
 
+def build_process_index(refresh=False):
+    global _process_index
 
-def search_free_dev_ip():
-    all_hosts = get_managed_host()
+    import psutil
 
-    choosen_ip = ''
-    pprint('Searching ip ...')
+    if _process_index is not None and not refresh:
+        return _process_index
 
-    for ip in IPS:
+    by_bind = {}
+    for proc in psutil.process_iter(['pid', 'cmdline', 'create_time']):
 
-        if ip not in {v: k for k, v in all_hosts.items()}:
-            pprint('    {} <=='.format(ip), continuous=True)
-            choosen_ip = ip
-            break
+        cmdline = proc.info['cmdline'] or []
+        joined = ' '.join(cmdline)
+        if 'manage.py runserver' not in joined or "bin/python" not in joined:
+            continue
 
-        pprint('    {} X'.format(ip), Mode.FAIL, continuous=True)
+        entry = {
+            'pid': proc.info['pid'],
+            'ip': runserver_bind(cmdline),
+            'location': short_location(cmdline[0]),
+            'create_time': proc.info['create_time'],
+        }
 
-    return choosen_ip
+        # The autoreloader spawns a child with the same cmdline, keep the oldest one
+        known = by_bind.get(entry['ip'])
+        if known and known['create_time'] <= entry['create_time']:
+            continue
 
+        by_bind[entry['ip']] = entry
 
-def create_caddy_config(hosts):
-    sections = [Section(f"https://{key}", Section(f"reverse_proxy {value}:8000")) for key, value in hosts.items()]
-    return '\n'.join(map(str, sections))
+    by_location = {}
+    for entry in by_bind.values():
+        by_location.setdefault(entry['location'], []).append(entry)
 
+    _process_index = {'by_bind': by_bind, 'by_location': by_location}
+    return _process_index
 
-def create_proxy_config(hosts):
-    if args.use_nginx:
-        return create_nginx_config(hosts)
-
-    return create_caddy_config(hosts)
-
-
-def create_nginx_config(hosts):
-    # sections = [
-    #     Section(
-    #         'server',
-    #         Location(
-    #             '/',
-    #             include='proxy_params',
-    #             proxy_pass='http://{}:{}'.format(value, BASE_PORT)
-    #         ),
-    #         listen='80',
-    #         server_name=key
-    #     ) for key, value in hosts.items()
-    # ]
-    sections = []
 
-    for key, value in hosts.items():
-        sections.append(
-            Section(
-                "server",
-                Location(
-                    "/",
-                    include="proxy_params",
-                    proxy_pass="http://{}:{}".format(value, BASE_PORT)
-                ),
-                listen="80",
-                server_name=key,
-            )
-        )
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    name TEXT PRIMARY KEY,
+    ip TEXT UNIQUE,
+    project_path TEXT,
+    options TEXT NOT NULL DEFAULT '{}',
+    created REAL,
+    last_start REAL
+);
+CREATE TABLE IF NOT EXISTS processes (
+    key TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    create_time REAL NOT NULL,
+    kind TEXT,
+    host TEXT,
+    info TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS processes_kind ON processes (kind);
+CREATE INDEX IF NOT EXISTS processes_host ON processes (host);
+CREATE TABLE IF NOT EXISTS reservations (
+    ip TEXT PRIMARY KEY,
+    host TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
 
-        cert_file_path = os.path.join(CERT_KEY_DEFAULT_PATH, f"{key}.pem")
-        key_file_path = os.path.join(CERT_KEY_DEFAULT_PATH, f"{key}-key.pem")
+_state = threading.local()
 
-        if not os.path.exists(cert_file_path) or not os.path.exists(key_file_path):
-            print(os.path.exists(cert_file_path), cert_file_path)
-            print(os.path.exists(key_file_path), key_file_path)
-            continue
 
-        pprint(f"Doing SSL for {key} with:", Mode.INFO)
-        print("CERT FILE:", cert_file_path)
-        print("KEY FILE:", key_file_path)
+def state_db():
+    db = getattr(_state, 'db', None)
 
-        # SSL
-        sections.append(
-            Section(
-                "server",
-                Location(
-                    "/",
-                    include="proxy_params",
-                    proxy_pass="https://{}:{}".format(value, BASE_PORT)
-                ),
-                ssl_certificate=cert_file_path,
-                ssl_certificate_key=key_file_path,
-                listen="443 ssl",
-                server_name=key,
-            )
-        )
+    if db is None:
+        import sqlite3
 
-    if False:  # Old and false
-        sections.append(
-            Section(
-                'server',
-                *(Location(
-                    '/{}/'.format(key.replace(SERVER_NAME_FORMAT.format(''), '')),
-                    KeyValueOption('include', 'proxy_params'),
-                    KeyValueOption('rewrite', '^/{}(/.*)$ http://{}$1 last'.format(key.replace(SERVER_NAME_FORMAT.format(''), ''), key)),
-                    KeyValueOption('proxy_pass', 'http://{}:{}'.format(value, BASE_PORT)),
-                    KeyValueOption('proxy_redirect', 'http://{}:{}/ $scheme://$host:$server_port/'.format(value, BASE_PORT)),
-                    KeyValuesMultiLines('proxy_set_header', [
-                        ['X-Real-IP', '$remote_addr'],
-                        ['X-Forwarded-For', '$proxy_add_x_forwarded_for'],
-                        # ['Host', 'django.local'],
-                        ['X-Forwarded-Proto', '$scheme'],
-                    ]),
-                ) for key, value in hosts.items()),
-                listen='80',
-                server_name=SERVER_NAME_FORMAT.format('django'),
-            )
-        )
+        os.makedirs(STATE_DIR, exist_ok=True)
+        db = sqlite3.connect(STATE_DB, timeout=STATE_DB_TIMEOUT, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        _state.db = db
 
-    sections.append(
-        Section(
-            "server",
-            *[
-                Location(
-                    "/",
-                    # KeyValueOption("rewrite", "^/{}(/.*)$ $1 break".format(key.rstrip(SERVER_NAME_FORMAT.format("")))),
-                    # KeyValueOption("proxy_pass", "http://{}:{}/".format(value, BASE_PORT)),
-                    # KeyValueOption("proxy_redirect", "http://{}:{}/ /".format(value, BASE_PORT)),
-                    # KeyValueOption("proxy_redirect", "$scheme://$host:$server_port/ /test/"),
-                    # KeyValueOption("proxy_set_header", "X-Real-IP $remote_addr"),
-                    # KeyValueOption("proxy_set_header", "X-Forwarded-For $proxy_add_x_forwarded_for"),
-                    # KeyValueOption("proxy_set_header", "Host $host"),
-                    # KeyValueOption("proxy_set_header", "X-Forwarded-Proto $scheme"),
-                    # KeyValueOption("proxy_buffering", "off"),
-                    # KeyValueOption("proxy_http_version", "1.1"),
-                    # KeyValueOption("proxy_request_buffering", "off"),
-                    KeyValueOption("include", "proxy_params"),
-                    KeyValueOption("proxy_pass", "http://127.0.0.2:8000/"),
-                ) for key, value in hosts.items()
-            ],
-            listen="80",
-            server_name=SERVER_NAME_FORMAT.format("django"),
-            client_max_body_size=0,
-        )
-    )
+        if db.execute('PRAGMA user_version').fetchone()[0] < STATE_VERSION:
+            migrate_state(db)
 
-    return '\n'.join(map(str, sections))
+    return db
 
 
-def update_proxy_config(config):
-    if args.use_nginx:
-        _update_proxy_config("/etc/nginx/sites-available/managed", config)
+@contextlib.contextmanager
+def state_transaction():
+    db = state_db()
+    db.execute('BEGIN IMMEDIATE')
 
-    else:
-        _update_proxy_config("/etc/caddy/Caddyfile", config)
+    try:
+        yield db
 
-    pprint('Reloading proxy service')
-    if args.use_nginx:
-        sh.sudo("systemctl", "restart", "nginx")
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
 
-    else:
-        sh.sudo("systemctl", "restart", "caddy")
+    db.execute('COMMIT')
 
-def _update_proxy_config(proxy_file, config):
 
-    temp_name = ''
+def migrate_state(db):
+    db.execute('BEGIN IMMEDIATE')
 
-    pprint('Write the proxy config in a temporary file')
-    with NamedTemporaryFile(delete=False) as temp:
-        temp.write(config.encode('utf-8'))
+    try:
+        # Another process may have migrated the store while we were waiting for the lock
+        version = db.execute('PRAGMA user_version').fetchone()[0]
 
-        temp_name = temp.name
+        if version < 1:
+            for statement in STATE_SCHEMA.split(';'):
+                if statement.strip():
+                    db.execute(statement)
 
-    pprint('Removing the actual proxy config file "{}"'.format(proxy_file))
+            import_legacy_state(db)
 
-    sh.sudo('rm', proxy_file)
+        if version < 2:
+            db.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
 
-    pprint('Copying the temporary file {} into the proxy conf'.format(temp_name))
+        db.execute('PRAGMA user_version = {}'.format(STATE_VERSION))
 
-    sh.sudo('cp', temp_name, proxy_file)
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
 
-    if not args.use_nginx:
-        sh.sudo('chown', 'caddy:', proxy_file)
+    db.execute('COMMIT')
 
 
-def get_tmux_windows_name():
-    tmux_name = sh.tmux.bake('display-message', '-p')('"#W"').split('\n', 1)[0].replace('"', '')
-    return tmux_name
+def get_setting(key, default=None):
+    row = state_db().execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+    return json.loads(row[0]) if row else default
 
 
-def get_project_name():
-    def normalize(txt):
-        return txt
+def set_setting(key, value):
+    with state_transaction() as db:
+        db.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, json.dumps(value)))
 
-    folder = os.getcwd().split("/")
-    name = "Documents"
-    if name in folder:
-        return folder[folder.index(name) + 2]
 
-    # If we cannot find a project name, try with the venv name
-    sp = sys.path[1].split('/')
-    if "env" in sp:
-        return normalize(sp[sp.index("env") + 1])
+def read_etc_hosts():
+    try:
+        with open('/etc/hosts', 'r') as etc:
+            return parse_managed_block(etc.read())[1]
 
-    return "default"
+    except OSError:
+        return {}
 
 
-def get_managepy_file():
-    def search(folder):
-        location = None
-        for filename in os.listdir(folder):
-            if filename.endswith("manage.py"):
-                location = os.path.join(folder, filename)
+def import_etc_hosts(db):
+    managed = read_etc_hosts()
+    now = time.time()
 
-        return location
+    db.execute('UPDATE hosts SET ip = NULL')
+    db.executemany(
+        'INSERT INTO hosts (name, ip, created) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET ip = excluded.ip',
+        [(name, ip, now) for name, ip in managed.items()],
+    )
 
-    folder = os.getcwd()
-    location = search(folder)
+    return managed
 
-    if not location:
-        for file in os.listdir(folder):
-            filename = os.path.join(folder, file)
-            if os.path.isdir(filename):
-                loc = search(filename)
-                if loc:
-                    location = loc
 
-    return location
+def import_legacy_state(db):
+    import_etc_hosts(db)
+    now = time.time()
+
+    with contextlib.suppress(OSError, ValueError):
+        with open(HOST_OPTIONS_FILE, 'r') as legacy:
+            for name, values in json.load(legacy).items():
+                db.execute('INSERT INTO hosts (name, options, created) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET options = excluded.options', (name, json.dumps(values), now))
+
+    with contextlib.suppress(OSError, ValueError):
+        with open(PID_REGISTRY_FILE, 'r') as legacy:
+            for key, entry in json.load(legacy).items():
+                entry = dict(entry)
+                db.execute(
+                    'INSERT OR REPLACE INTO processes (key, pid, create_time, kind, host, info) VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, entry.pop('pid'), entry.pop('create_time'), entry.pop('kind', None), entry.pop('host', None), json.dumps(entry)),
+                )
+
+
+def get_registered_process(key):
+    row = state_db().execute('SELECT key, pid, create_time, kind, host, info FROM processes WHERE key = ?', (key,)).fetchone()
+    return process_entry(row) if row else None
+
+
+def process_entry(row):
+    key, pid, create_time, kind, host, info = row
+    return {'pid': pid, 'create_time': create_time, 'kind': kind, 'host': host, **json.loads(info)}
+
+
+def register_process(key, pid, kind=None, host=None, **info):
+    import psutil
+
+    with state_transaction() as db:
+        db.execute(
+            'INSERT OR REPLACE INTO processes (key, pid, create_time, kind, host, info) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, pid, psutil.Process(pid).create_time(), kind, host, json.dumps(info)),
+        )
+
+
+def unregister_process(key, pid):
+    with state_transaction() as db:
+        db.execute('DELETE FROM processes WHERE key = ? AND pid = ?', (key, pid))
+
+
+def register_django(bind, pid, location):
+    register_process(bind, pid, kind='runserver', host=host_for_ip(bind.split(':')[0]), ip=bind, location=location)
 
 
-def is_django_active(endpoint):
-    active_djangos = get_active_djangos()
+def unregister_django(bind, pid):
+    unregister_process(bind, pid)
 
-    if endpoint not in active_djangos:
+
+def get_celery_processes():
+    rows = state_db().execute("SELECT key, pid, create_time, kind, host, info FROM processes WHERE kind IN ('celery', 'beat')")
+    return {row[0]: entry for row in rows for entry in [process_entry(row)] if is_registered_alive(entry)}
+
+
+def is_registered_alive(entry):
+    import psutil
+
+    try:
+        proc = psutil.Process(entry['pid'])
+        return abs(proc.create_time() - entry['create_time']) < 1
+
+    except (psutil.Error, KeyError):
         return False
 
-    return '{}:{}'.format(ip, BASE_PORT) in active_djangos()
 
+def lookup_django(bind):
+    entry = get_registered_process(bind)
 
-def django_server_activate(managepy_location, endpoint, commands=[], args=(), kwargs=None):
-    for c in commands:
-        pprint("Running command: {}".format(c))
-        subprocess.call(c.split(" "))
+    if entry and is_registered_alive(entry):
+        return entry
 
-    command = ['python', managepy_location, 'runserver', '{}:{}'.format(endpoint, BASE_PORT), *args, *uargs]
-    if kwargs.with_debug:
-        command = ["python", "-m", "debugpy", "--wait-for-client", "--listen", f"{endpoint}:5678", managepy_location, "runserver", f"{endpoint}:{BASE_PORT}", *args, *uargs]
+    return build_process_index()['by_bind'].get(bind)
 
-        if kwargs.no_wait_for_client:
-            command.pop(3)
 
-    subprocess.call(command)
+def get_managed_host():
+    rows = state_db().execute('SELECT name, ip FROM hosts WHERE ip IS NOT NULL ORDER BY rowid')
+    return dict(rows)
 
 
-def clear_all():
-    pprint('Removing /etc/hosts managed configs')
-    update_managed_host({})
-    pprint('Removing nginx managed config')
-    update_proxy_config('')
+def host_for_ip(ip):
+    row = state_db().execute('SELECT name FROM hosts WHERE ip = ?', (ip,)).fetchone()
+    return row[0] if row else None
 
 
-def main():
+def host_options(host):
+    row = state_db().execute('SELECT options FROM hosts WHERE name = ?', (host,)).fetchone()
+    return json.loads(row[0]) if row else {}
 
-    skip_creation = False
 
-    choosen_ip = ''
+def save_host_options(host, **values):
+    with state_transaction() as db:
+        row = db.execute('SELECT options FROM hosts WHERE name = ?', (host,)).fetchone()
+        current = json.loads(row[0]) if row else {}
 
-    active_hosts = get_managed_host()
+        changed = any(current.get(key) != value for key, value in values.items())
 
-    print(get_active_djangos())
+        if row and not changed:
+            return False
 
-    if args.use_tmux_window_name:
-        active_tmux_windows = get_tmux_windows_name()
+        db.execute(
+            'INSERT INTO hosts (name, options, created) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET options = excluded.options',
+            (host, json.dumps({**current, **values}), time.time()),
+        )
 
-    else:
-        active_tmux_windows = get_project_name()
+    return changed
 
-    if args.with_debug:
-        pass
-        # If we want the installer, we need to have it.
-        # This need to be done in the target venv, not in the django-run venv, aborting for now
-        # pprint("Searching for debugpy packages", Mode.INFO)
-        # for module in pkgutil.iter_modules():
-        #     if module.name == "debugpy":
-        #         pprint("Debugger debugpy found", Mode.INFO)
-        #         break
-        #
-        # else:
-        #     pprint("Debugger debugpy not found, installing", Mode.WARNING)
-        #     pip.main(["install", "debugpy"])
 
-    if args.clear:
-        if not args.confirm_clear:
-            pprint("It's gonna erase ALL managed host, and ALL managed nginx config, use --confirm-clear to to so", Mode.WARNING)
-            sys.exit(0)
+def record_launch(host, project_path, argv, python):
+    save_host_options(host, argv=argv, python=python)
 
-        else:
-            clear_all()
-            sys.exit(0)
+    with state_transaction() as db:
+        db.execute('UPDATE hosts SET project_path = ?, last_start = ? WHERE name = ?', (project_path, time.time(), host))
 
-    if args.managed:
-        pprint('Managed hosts: ', Mode.OPERATION)
 
-        for host, ip in active_hosts.items():
+def get_host_record(host):
+    row = state_db().execute('SELECT name, ip, project_path, options, created, last_start FROM hosts WHERE name = ?', (host,)).fetchone()
 
-            text = '{} @ {}'.format(host, ip)
-            pprint(text)
+    if not row:
+        return None
 
-        pprint('Found running django servers: ', Mode.OPERATION)
-        for running_django in get_active_djangos(get_name=True):
+    name, ip, project_path, options, created, last_start = row
+    return {'name': name, 'ip': ip, 'project_path': project_path, 'options': json.loads(options), 'created': created, 'last_start': last_start}
 
-            pprint(running_django['location'], continuous=True, end='')
-            pprint(" : with IP: http://", Mode.OPERATION, continuous=True, end='')
-            pprint(running_django['ip'], continuous=True)
 
-        pprint('Normaly, those are correct and running:', Mode.OPERATION)
+def worker_ports(host):
+    workers = host_options(host).get('workers', 1)
+    return [str(int(BASE_PORT) + offset) for offset in range(workers)]
 
-        for host, ip in active_hosts.items():
-            for running_django in get_active_djangos(get_name=True):
-                if '{}:{}'.format(ip, BASE_PORT) == running_django['ip']:
-                    pprint('{}{}{} - {}{: <30}{} => {}(env){} {}{}{}'.format(
-                        Mode.BOLD.value,
-                        ip,
-                        Mode.NORMAL.value,
-                        Mode.INFO.value,
-                        host,
-                        Mode.NORMAL.value,
-                        Mode.BOLD.value,
-                        Mode.NORMAL.value,
-                        Mode.OPERATION.value,
-                        running_django['location'],
-                        Mode.NORMAL.value
-                    ))
-
-        sys.exit(0)
-
-    if args.config:
-        if args.use_nginx:
-            pprint('Normal nginx config file:', Mode.OPERATION)
 
-        else:
-            pprint('Normal caddy config file:', Mode.OPERATION)
+def run_privileged_helper(change_set):
+    command = [sys.executable, HELPER_PATH]
+    if os.geteuid() != 0:
+        command = ['sudo', *command]
 
-        normal_proxy_config = create_proxy_config(active_hosts)
+    completed = subprocess.run(command, input=json.dumps(change_set), capture_output=True, text=True)
 
-        pprint(normal_proxy_config, Mode.NORMAL, continuous=True)
-        sys.exit(0)
+    if completed.returncode:
+        pprint('Privileged helper failed: {}'.format(completed.stderr.strip()), Mode.FAIL)
+        return None
 
-    if args.open_all:
-        for host in get_active_djangos(get_name=True):
-            pprint('Opening [{}] endpoint in firefox [IP={}]'.format(host["location"], host["ip"]))
+    result = json.loads(completed.stdout or '{}')
+    if result.get('reload_error'):
+        pprint('Proxy reload failed: {}'.format(result['reload_error']), Mode.FAIL)
 
-            FirefoxAsyncLaunch('http://{}'.format(SERVER_NAME_FORMAT.format(host["location"]))).start()
+    return result
 
-        sys.exit(0)
 
-    if args.remove:
-        pprint("Following host will be erased:", Mode.WARNING)
-        old_active_hosts = copy.deepcopy(active_hosts)
+_privileged_batch = None
 
-        for to_remove in args.remove:
-            for host, ip in old_active_hosts.items():
-                # Remove if name match
-                if to_remove.lower() in host:
-                    pprint("Removing {} with ip {}".format(host, ip))
 
-                    active_hosts.pop(host, None)
+def merge_change_sets(batch, change_set):
+    files = {file['path']: file for file in batch.get('files', [])}
+    removed = set(batch.get('remove', []))
 
-                # Or ip
-                if to_remove.lower() in ip:
-                    pprint("Removing {} with ip {}".format(host, ip))
+    for file in change_set.get('files', []):
+        files[file['path']] = file
+        removed.discard(file['path'])
 
-                    active_hosts.pop(host, None)
+    for path in change_set.get('remove', []):
+        files.pop(path, None)
+        removed.add(path)
 
-        if not args.reload_config:
-            pprint("No host realy removed, to apply change, use --reload-config to write down the config")
+    # Host diffs are always taken against the untouched /etc/hosts, so the latest one is complete
+    merged = {**batch, **{key: change_set[key] for key in ('hosts', 'reload') if key in change_set}}
+    merged.pop('files', None)
+    merged.pop('remove', None)
 
-    if args.erase:
+    if files:
+        merged['files'] = list(files.values())
 
-        for to_be_erased in args.erase:
-            if active_hosts.get(to_be_erased):
-                active_hosts.pop(to_be_erased)
-                pprint(f"Removing {to_be_erased} from /etc/hosts and nginx config")
+    if removed:
+        merged['remove'] = sorted(removed)
 
-        update_managed_host(active_hosts)
-        update_proxy_config(create_proxy_config(active_hosts))
-        sys.exit(0)
+    return merged
 
-    if args.reload_config:
 
-        update_managed_host(active_hosts)
-        update_proxy_config(create_proxy_config(active_hosts))
-        sys.exit(0)
+def submit_privileged(change_set):
+    global _privileged_batch
 
-    if args.see_tmux_name:
-        pprint("Tmux window's name: {}, server host: {}".format(active_tmux_windows, SERVER_NAME_FORMAT.format(active_tmux_windows)), Mode.INFO)
+    if _privileged_batch is None:
+        return run_privileged_helper(change_set)
 
-    which_python = sh.which("python")
-    rmatch = re.match(".*\/miniconda3\/envs\/(?P<env>.*)\/bin\/python", which_python)
+    _privileged_batch = merge_change_sets(_privileged_batch, change_set)
+    return {}
 
-    if rmatch:
-        env = rmatch.groupdict().get("env")
 
-        if args.prefix_name:
-            env = f"{args.prefix_name}.{env}"
+@contextlib.contextmanager
+def privileged_batch():
+    global _privileged_batch
 
-        if args.suffix_name:
-            env = f"{env}.{args.suffix_name}"
+    if _privileged_batch is not None:
+        yield
+        return
 
-        server_endpoint = SERVER_NAME_FORMAT.format(env)
+    _privileged_batch = {}
+    try:
+        yield
+        change_set = _privileged_batch
 
-    else:
-        server_endpoint = SERVER_NAME_FORMAT.format(active_tmux_windows)
+    finally:
+        _privileged_batch = None
 
-    if args.name:
-        server_endpoint = SERVER_NAME_FORMAT.format(args.name)
+    if change_set:
+        run_privileged_helper(change_set)
 
-    if args.raw_name:
-        server_endpoint = args.raw_name
 
-    location_managepy = get_managepy_file()
+def update_managed_host(hosts):
+    with state_transaction() as db:
+        stored = dict(db.execute('SELECT name, ip FROM hosts WHERE ip IS NOT NULL'))
+
+        for name in stored:
+            if name not in hosts:
+                db.execute('UPDATE hosts SET ip = NULL WHERE name = ?', (name,))
+
+        # Clear the ips first so that two hosts can swap addresses without hitting the unique index
+        changed = [name for name, ip in hosts.items() if stored.get(name) != ip]
+        db.executemany('UPDATE hosts SET ip = NULL WHERE name = ?', [(name,) for name in changed])
+        db.executemany(
+            'INSERT INTO hosts (name, ip, created) VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE SET ip = excluded.ip',
+            [(name, hosts[name], time.time()) for name in changed],
+        )
+        db.executemany('DELETE FROM reservations WHERE ip = ?', [(hosts[name],) for name in changed])
 
-    if not location_managepy:
-        pprint('No manage.py file found !', Mode.FAIL)
-        skip_creation = True
+    render_etc_hosts()
 
-    else:
-        pprint('Manage.py file found: {}'.format(location_managepy))
 
-    cert_file_name = os.path.join(CERT_KEY_DEFAULT_PATH, f"{server_endpoint}.pem")
-    key_file_name = os.path.join(CERT_KEY_DEFAULT_PATH, f"{server_endpoint}-key.pem")
-    print("CERT FILE:", cert_file_name)
-    print("KEY FILE:", key_file_name)
+def render_etc_hosts():
+    current = read_etc_hosts()
+    hosts = get_managed_host() if get_setting('hosts_file', True) else {}
 
-    more_args = ("--cert-file", cert_file_name, "--key-file", key_file_name) if args.use_ssl else ()
+    added = {name: ip for name, ip in hosts.items() if current.get(name) != ip}
+    removed = [name for name in current if name not in hosts]
 
-    if server_endpoint in active_hosts:
-        skip_creation = True
+    if not added and not removed:
+        pprint('Managed hosts unchanged, skipping /etc/hosts write', Mode.INFO)
+        return
 
-        pprint('Host already in config for this name!', Mode.FAIL)
-        pprint('Ip for {} is {}'.format(server_endpoint, active_hosts[server_endpoint]), Mode.INFO)
+    submit_privileged({'hosts': {'added': added, 'removed': removed}})
 
-        choosen_ip = active_hosts[server_endpoint]
 
-    if not skip_creation:
-        choosen_ip = search_free_dev_ip()
+def parse_ip_range(ip_range):
+    if '/' in ip_range:
+        return [str(ip) for ip in ipaddress.ip_network(ip_range, strict=False).hosts()]
 
-        pprint('Creating /etc/hosts config for {} @ {}'.format(server_endpoint, choosen_ip))
+    first, _, last = ip_range.partition('-')
+    first = ipaddress.ip_address(first.strip())
 
-        active_hosts[server_endpoint] = choosen_ip
-        update_managed_host(active_hosts)
+    if not last:
+        return [str(first)]
 
-        pprint('Creating Nginx config for {} @ {}'.format(server_endpoint, choosen_ip))
+    last = last.strip()
+    if '.' not in last:
+        last = '{}.{}'.format(str(first).rsplit('.', 1)[0], last)
 
-        nginx_config = create_proxy_config(active_hosts)
-        update_proxy_config(nginx_config)
+    return [str(ipaddress.ip_address(i)) for i in range(int(first), int(ipaddress.ip_address(last)) + 1)]
 
-    is_active = is_django_active(server_endpoint)
 
-    if not args.no_open and is_active:
-        pprint('Opening the endpoint in firefox, since \'--no-open\' is not passed', Mode.OPERATION)
+def is_bindable(ip, port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        FirefoxAsyncLaunch('http://{}'.format(server_endpoint)).start()
+        try:
+            sock.bind((ip, int(port)))
+            return True
 
-    if not is_active and location_managepy:
-        pprint('Opening the endpoint in firefox, since \'--no-open\' is not passed', Mode.OPERATION)
+        except OSError:
+            return False
 
-        FirefoxAsyncLaunch('http://{}'.format(server_endpoint)).start()
 
-        pprint('Running django server {} @ {}'.format(server_endpoint, choosen_ip))
+class IpAllocator:
 
-        if args.celery:
-            CeleryWorker(server_endpoint).start()
+    def __init__(self, ip_ranges):
+        self.pool = []
+        for ip_range in ip_ranges:
+            self.pool.extend(ip for ip in parse_ip_range(ip_range) if ip not in self.pool)
 
-        commands = []
-        if args.sls:
-            commands.append(f"python {location_managepy} generate_sls tmp_states -yy")
-            commands.append(f"python {location_managepy} generate_extra_sls tmp_states_extra -yy")
+        self.positions = {ip: position for position, ip in enumerate(self.pool)}
+        self.bitmap = bytearray(len(self.pool))
 
-        django_server_activate(location_managepy, active_hosts[server_endpoint], commands, args=more_args, kwargs=args)
+    def mark_used(self, ip):
+        position = self.positions.get(ip)
+        if position is not None:
+            self.bitmap[position] = 1
 
-    elif not location_managepy:
-        pprint('Exiting ...', Mode.FAIL)
+    def allocate(self, port):
+        position = self.bitmap.find(0)
+
+        while position != -1:
+            ip = self.pool[position]
+            self.bitmap[position] = 1
+
+            if is_bindable(ip, port):
+                return ip
+
+            position = self.bitmap.find(0, position + 1)
+
+        return ''
+
+
+def search_free_dev_ip(host):
+    with state_transaction() as db:
+        now = time.time()
+        db.execute('DELETE FROM reservations WHERE expires <= ?', (now,))
+
+        allocator = IpAllocator(args.ip_range or DEFAULT_IP_RANGES)
+        for (ip,) in db.execute('SELECT ip FROM hosts WHERE ip IS NOT NULL UNION SELECT ip FROM reservations'):
+            allocator.mark_used(ip)
+
+        choosen_ip = allocator.allocate(BASE_PORT)
+
+        if choosen_ip:
+            db.execute('INSERT INTO reservations (ip, host, expires) VALUES (?, ?, ?)', (choosen_ip, host, now + RESERVATION_TTL))
+
+    if choosen_ip:
+        pprint('Found free ip {}'.format(choosen_ip))
 
     else:
-        pprint('Django server already running!')
+        pprint('No free ip left in {}'.format(', '.join(args.ip_range or DEFAULT_IP_RANGES)), Mode.FAIL)
+
+    return choosen_ip
+
+
+_certificate_index = None
+
+
+def certificate_index():
+    global _certificate_index
+
+    try:
+        mtime = os.stat(CERT_KEY_DEFAULT_PATH).st_mtime
+
+    except OSError:
+        return set()
+
+    if _certificate_index is None or _certificate_index[0] != mtime:
+        with os.scandir(CERT_KEY_DEFAULT_PATH) as entries:
+            _certificate_index = (mtime, {entry.name for entry in entries if entry.is_file()})
+
+    return _certificate_index[1]
+
+
+def get_certificate(host):
+    names = certificate_index()
+
+    if f"{host}.pem" in names and f"{host}-key.pem" in names:
+        return os.path.join(CERT_KEY_DEFAULT_PATH, f"{host}.pem"), os.path.join(CERT_KEY_DEFAULT_PATH, f"{host}-key.pem")
+
+    return None
+
+
+def certificate_expiry(cert_file_path):
+    try:
+        from cryptography import x509
+
+    except ImportError:
+        return None
+
+    try:
+        with open(cert_file_path, 'rb') as cert_file:
+            return x509.load_pem_x509_certificate(cert_file.read()).not_valid_after_utc.timestamp()
+
+    except (OSError, ValueError):
+        return None
+
+
+def write_private_file(path, data):
+    descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    with os.fdopen(descriptor, 'wb') as file:
+        file.write(data)
+
+
+def load_or_create_ca():
+    import datetime
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    cert_file_path = os.path.join(CERT_KEY_DEFAULT_PATH, f"{CERT_CA_NAME}.pem")
+    key_file_path = os.path.join(CERT_KEY_DEFAULT_PATH, f"{CERT_CA_NAME}-key.pem")
+
+    if os.path.exists(cert_file_path) and os.path.exists(key_file_path):
+        with open(key_file_path, 'rb') as key_file, open(cert_file_path, 'rb') as cert_file:
+            return serialization.load_pem_private_key(key_file.read(), None), x509.load_pem_x509_certificate(cert_file.read())
+
+    pprint('Creating the local CA {}'.format(cert_file_path), Mode.OPERATION)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "django-run local CA")])
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=10 * 365))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        .add_extension(x509.KeyUsage(False, False, False, False, False, True, True, False, False), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+
+    os.makedirs(CERT_KEY_DEFAULT_PATH, exist_ok=True)
+    write_private_file(key_file_path, key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    with open(cert_file_path, 'wb') as cert_file:
+        cert_file.write(cert.public_bytes(serialization.Encoding.PEM))
+
+    pprint('Trust it once, e.g. sudo cp {} /usr/local/share/ca-certificates/{}.crt && sudo update-ca-certificates'.format(cert_file_path, CERT_CA_NAME), Mode.INFO)
+    return key, cert
+
+
+def generate_certificates(hosts):
+    try:
+        import datetime
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+
+    except ImportError:
+        pprint("The 'cryptography' package is needed to generate certificates: pip install cryptography", Mode.FAIL)
+        return []
+
+    ca_key, ca_cert = load_or_create_ca()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    generated = []
+
+    for host in hosts:
+        key = ec.generate_private_key(ec.SECP256R1())
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)]))
+            .issuer_name(ca_cert.subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=CERT_VALIDITY_DAYS))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(host), x509.DNSName(f"*.{host}")]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH]), critical=False)
+            .sign(ca_key, hashes.SHA256())
+        )
+
+        write_private_file(os.path.join(CERT_KEY_DEFAULT_PATH, f"{host}-key.pem"), key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+        with open(os.path.join(CERT_KEY_DEFAULT_PATH, f"{host}.pem"), 'wb') as cert_file:
+            cert_file.write(cert.public_bytes(serialization.Encoding.PEM))
+
+        pprint('Certificate generated for {}'.format(host))
+        generated.append(host)
+
+    return generated
+
+
+def certificates_to_renew(hosts):
+    limit = time.time() + CERT_EXPIRY_WARNING_DAYS * 86400
+    to_renew = []
+
+    for host in hosts:
+        certificate = get_certificate(host)
+        expiry = certificate_expiry(certificate[0]) if certificate else None
+
+        if expiry is None or expiry < limit:
+            to_renew.append(host)
+
+    return to_renew
+
+
+def create_caddy_sections(key, value):
+    # Off by default: the keys are private to the user, and Caddy rejects a config whose key it cannot read
+    certificate = get_certificate(key) if get_setting('caddy_tls', False) else None
+    options = host_options(key)
+    static_paths = options.get('static_paths', [])
+    address = f"https://{key}, https://*.{key}" if options.get('wildcard') else f"https://{key}"
+
+    # Caddy directives take no trailing semicolon, so the block is written by hand and the nginx API is only needed for nginx
+    ports = worker_ports(key)
+    upstreams = ' '.join(f"{value}:{port}" for port in ports)
+    proxy = f"reverse_proxy {upstreams}\n"
+    if len(ports) > 1:
+        proxy = (
+            f"reverse_proxy {upstreams} {{\n"
+            f"    lb_policy least_conn\n"
+            f"    lb_try_duration 5s\n"
+            f"    fail_duration 30s\n"
+            f"    max_fails 3\n"
+            f"    unhealthy_status 5xx\n"
+            f"}}\n"
+        )
+
+    lines = "tls {} {}\n".format(*certificate) if certificate else ""
+
+    if static_paths:
+        lines += "encode zstd gzip\n@on_disk file\n"
+
+    for url, root in static_paths:
+        prefix = url.rstrip('/')
+
+        # Files missing from the root (not collected yet) still reach Django under their original path
+        lines += (
+            f"route {prefix}/* {{\n"
+            f"    uri strip_prefix {prefix}\n"
+            f"    root * {root}\n"
+            f"    header @on_disk Cache-Control \"no-cache\"\n"
+            f"    file_server @on_disk\n"
+            f"    rewrite * {prefix}{{uri}}\n"
+            f"{textwrap.indent(proxy, '    ')}"
+            f"}}\n"
+        )
+
+    return [f"{address} {{\n{textwrap.indent(lines + proxy, '    ')}}}"]
+
+
+def create_caddy_config(hosts):
+    sections = [section for key, value in hosts.items() for section in create_caddy_sections(key, value)]
+    return '\n'.join(map(str, sections))
+
+
+def create_proxy_config(hosts):
+    return get_proxy_backend().render(hosts)
+
+
+def create_nginx_sections(key, value):
+    from nginx.config.api import Section, Location, KeyOption, KeyValueOption
+
+    sections = []
+    upstream = "{}:{}".format(value, BASE_PORT)
+    server_name = "{0} *.{0}".format(key) if host_options(key).get('wildcard') else key
+
+    ports = worker_ports(key)
+    if len(ports) > 1:
+        upstream = "django_{}".format(re.sub(r"\W", "_", key))
+        sections.append(
+            Section(
+                "upstream {}".format(upstream),
+                KeyOption("least_conn"),
+                *[KeyValueOption("server", "{}:{} max_fails=3 fail_timeout=30s".format(value, port)) for port in ports],
+            )
+        )
+
+    sections.append(
+        Section(
+            "server",
+            Location(
+                "/",
+                include="proxy_params",
+                proxy_pass="http://{}".format(upstream)
+            ),
+            *create_nginx_static_locations(key, "http://{}".format(upstream)),
+            listen="80",
+            server_name=server_name,
+        )
+    )
+
+    certificate = get_certificate(key)
+
+    if not certificate:
+        return sections
+
+    cert_file_path, key_file_path = certificate
+
+    # SSL
+    sections.append(
+        Section(
+            "server",
+            Location(
+                "/",
+                include="proxy_params",
+                proxy_pass="https://{}".format(upstream)
+            ),
+            *create_nginx_static_locations(key, "https://{}".format(upstream)),
+            ssl_certificate=cert_file_path,
+            ssl_certificate_key=key_file_path,
+            listen="443 ssl",
+            server_name=server_name,
+        )
+    )
+
+    return sections
+
+
+def create_nginx_static_locations(key, proxy_pass):
+    from nginx.config.api import Location, KeyValueOption
+
+    static_paths = host_options(key).get('static_paths', [])
+    if not static_paths:
+        return []
+
+    fallback = "@django_{}".format(re.sub(r"\W", "_", key))
+    locations = [Location(fallback, include="proxy_params", proxy_pass=proxy_pass)]
+
+    for url, root in static_paths:
+        locations.append(
+            Location(
+                "^~ {}/".format(url.rstrip('/')),
+                KeyValueOption("add_header", 'Cache-Control "no-cache"'),
+                KeyValueOption("gzip_types", "text/css application/javascript image/svg+xml application/json"),
+                # Files missing from the root (not collected yet) still reach Django
+                KeyValueOption("error_page", "404 = {}".format(fallback)),
+                alias="{}/".format(root.rstrip('/')),
+                etag="on",
+                gzip="on",
+            )
+        )
+
+    return locations
+
+
+def create_nginx_main_sections(hosts):
+    from nginx.config.api.options import KeyValuesMultiLines
+    from nginx.config.api import Section, Location, KeyValueOption
+
+    sections = []
+
+    if False:  # Old and false
+        sections.append(
+            Section(
+                'server',
+                *(Location(
+                    '/{}/'.format(key.replace(SERVER_NAME_FORMAT.format(''), '')),
+                    KeyValueOption('include', 'proxy_params'),
+                    KeyValueOption('rewrite', '^/{}(/.*)$ http://{}$1 last'.format(key.replace(SERVER_NAME_FORMAT.format(''), ''), key)),
+                    KeyValueOption('proxy_pass', 'http://{}:{}'.format(value, BASE_PORT)),
+                    KeyValueOption('proxy_redirect', 'http://{}:{}/ $scheme://$host:$server_port/'.format(value, BASE_PORT)),
+                    KeyValuesMultiLines('proxy_set_header', [
+                        ['X-Real-IP', '$remote_addr'],
+                        ['X-Forwarded-For', '$proxy_add_x_forwarded_for'],
+                        # ['Host', 'django.local'],
+                        ['X-Forwarded-Proto', '$scheme'],
+                    ]),
+                ) for key, value in hosts.items()),
+                listen='80',
+                server_name=SERVER_NAME_FORMAT.format('django'),
+            )
+        )
+
+    if not hosts:
+        return sections
+
+    sections.append(
+        Section(
+            "server",
+            Location(
+                "/",
+                # KeyValueOption("rewrite", "^/{}(/.*)$ $1 break".format(key.rstrip(SERVER_NAME_FORMAT.format("")))),
+                # KeyValueOption("proxy_pass", "http://{}:{}/".format(value, BASE_PORT)),
+                # KeyValueOption("proxy_redirect", "http://{}:{}/ /".format(value, BASE_PORT)),
+                # KeyValueOption("proxy_redirect", "$scheme://$host:$server_port/ /test/"),
+                # KeyValueOption("proxy_set_header", "X-Real-IP $remote_addr"),
+                # KeyValueOption("proxy_set_header", "X-Forwarded-For $proxy_add_x_forwarded_for"),
+                # KeyValueOption("proxy_set_header", "Host $host"),
+                # KeyValueOption("proxy_set_header", "X-Forwarded-Proto $scheme"),
+                # KeyValueOption("proxy_buffering", "off"),
+                # KeyValueOption("proxy_http_version", "1.1"),
+                # KeyValueOption("proxy_request_buffering", "off"),
+                KeyValueOption("include", "proxy_params"),
+                KeyValueOption("proxy_pass", "http://127.0.0.2:8000/"),
+            ),
+            listen="80",
+            server_name=SERVER_NAME_FORMAT.format("django"),
+            client_max_body_size=0,
+        )
+    )
+
+    return sections
+
+
+def stamp_fragment(body):
+    digest = hashlib.sha256(body.encode('utf-8')).hexdigest()[:16]
+    return '{}{}\n{}\n'.format(FRAGMENT_HASH_MARKER, digest, body), digest
+
+
+def read_text_file(path):
+    try:
+        with open(path, 'r') as file:
+            return file.read()
+
+    except OSError:
+        return None
+
+
+class ProxyBackend:
+    name = ''
+    config_file = ''
+    fragment_dir = ''
+    fragment_extension = ''
+    owner = None
+
+    def render_fragment(self, host, ip):
+        raise NotImplementedError
+
+    def render_main(self, hosts):
+        raise NotImplementedError
+
+    def render(self, hosts):
+        return '\n'.join([self.render_main(hosts), *(self.render_fragment(host, ip) for host, ip in hosts.items())])
+
+    def fragment_path(self, host):
+        return os.path.join(self.fragment_dir, host + self.fragment_extension)
+
+    def read_fragment_hashes(self):
+        hashes = {}
+
+        try:
+            entries = os.scandir(self.fragment_dir)
+
+        except FileNotFoundError:
+            return hashes
+
+        with entries:
+            for entry in entries:
+                if not entry.name.endswith(self.fragment_extension):
+                    continue
+
+                with open(entry.path, 'r') as fragment:
+                    first_line = fragment.readline()
+
+                host = entry.name[:-len(self.fragment_extension)]
+                hashes[host] = first_line[len(FRAGMENT_HASH_MARKER):].strip() if first_line.startswith(FRAGMENT_HASH_MARKER) else ''
+
+        return hashes
+
+    def changes(self, hosts, force=False):
+        existing = self.read_fragment_hashes()
+        files = []
+
+        main_config = self.render_main(hosts)
+        if force or read_text_file(self.config_file) != main_config:
+            files.append({'path': self.config_file, 'content': main_config, 'owner': self.owner})
+
+        for host, ip in hosts.items():
+            content, digest = stamp_fragment(self.render_fragment(host, ip))
+
+            if force or existing.get(host) != digest:
+                files.append({'path': self.fragment_path(host), 'content': content, 'owner': self.owner})
+
+        removed = [self.fragment_path(host) for host in existing if host not in hosts]
+
+        if not files and not removed:
+            return None
+
+        return {'files': files, 'remove': removed}
+
+    def reload(self, config):
+        return submit_privileged({'reload': self.reload_request()}) is not None
+
+    def reload_request(self):
+        return {'backend': self.name}
+
+
+class CaddyBackend(ProxyBackend):
+    name = 'caddy'
+    config_file = CADDY_CONFIG_FILE
+    fragment_dir = CADDY_FRAGMENT_DIR
+    fragment_extension = '.caddy'
+    owner = 'caddy'
+
+    def render_fragment(self, host, ip):
+        return create_caddy_config({host: ip})
+
+    def render_main(self, hosts):
+        return 'import {}/*{}\n'.format(self.fragment_dir, self.fragment_extension)
+
+    def reload_request(self):
+        return {'backend': self.name, 'admin': args.caddy_admin}
+
+    def reload(self, config):
+        import urllib.error
+        import urllib.request
+
+        request = urllib.request.Request(
+            '{}/load'.format(args.caddy_admin.rstrip('/')),
+            data=config.encode('utf-8'),
+            headers={'Content-Type': 'text/caddyfile'},
+            method='POST',
+        )
+
+        try:
+            with urllib.request.urlopen(request, timeout=10):
+                return True
+
+        except urllib.error.HTTPError as error:
+            pprint('Caddy refused the config: {}'.format(error.read().decode('utf-8', 'replace').strip()), Mode.FAIL)
+            return False
+
+        except OSError as error:
+            pprint('Caddy admin API unreachable ({}), falling back to systemctl reload'.format(error), Mode.WARNING)
+            return super().reload(config)
+
+
+class NginxBackend(ProxyBackend):
+    name = 'nginx'
+    config_file = NGINX_CONFIG_FILE
+    fragment_dir = NGINX_FRAGMENT_DIR
+    fragment_extension = '.conf'
+
+    def render_fragment(self, host, ip):
+        return '\n'.join(map(str, create_nginx_sections(host, ip)))
+
+    def render_main(self, hosts):
+        from nginx.config.api import KeyValueOption
+
+        sections = [KeyValueOption('include', '{}/*{}'.format(self.fragment_dir, self.fragment_extension))]
+        sections.extend(create_nginx_main_sections(hosts))
+
+        return '\n'.join(map(str, sections))
+
+
+def get_proxy_backend():
+    if args.use_nginx:
+        return NginxBackend()
+
+    return CaddyBackend()
+
+
+def update_proxy_config(hosts, force=False):
+    backend = get_proxy_backend()
+    config = backend.render_main(hosts)
+    changes = backend.changes(hosts, force=force)
+
+    if changes:
+        pprint('Writing {} proxy config file(s), removing {}, reloading {}'.format(len(changes['files']), len(changes['remove']), backend.name))
+        # Files and reload go in the same helper run, so a config the proxy rejects is rolled back
+        submit_privileged({**changes, 'reload': backend.reload_request()})
+
+    elif force:
+        pprint('Reloading {} config'.format(backend.name))
+        if not backend.reload(config):
+            pprint('Proxy reload failed', Mode.FAIL)
+
+    else:
+        pprint('Proxy config unchanged, skipping write and reload', Mode.INFO)
+
+
+def get_tmux_windows_name():
+    import sh
+
+    tmux_name = sh.tmux.bake('display-message', '-p')('"#W"').split('\n', 1)[0].replace('"', '')
+    return tmux_name
+
+
+def get_project_name():
+    def normalize(txt):
+        return txt
+
+    folder = os.getcwd().split("/")
+    name = "Documents"
+    if name in folder:
+        return folder[folder.index(name) + 2]
+
+    # If we cannot find a project name, try with the venv name
+    sp = sys.path[1].split('/')
+    if "env" in sp:
+        return normalize(sp[sp.index("env") + 1])
+
+    return "default"
+
+
+def search_managepy(folder, depth, ignore):
+    level = [folder]
+
+    # Breadth first: the shallowest manage.py wins, so deeper levels are only walked when needed
+    for current_depth in range(depth + 1):
+        found = []
+        next_level = []
+
+        for directory in level:
+            try:
+                entries = os.scandir(directory)
+
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not any(fnmatch.fnmatch(entry.name, pattern) for pattern in ignore):
+                            next_level.append(entry.path)
+
+                    elif entry.name.endswith("manage.py"):
+                        found.append(entry.path)
+
+        if found:
+            # Prefer a plain manage.py, then keep the order stable across runs
+            return sorted(found, key=lambda path: (os.path.basename(path) != "manage.py", path))[0]
+
+        level = next_level
+
+    return None
+
+
+def load_managepy_cache():
+    try:
+        with open(MANAGEPY_CACHE_FILE, 'r') as cache:
+            return json.load(cache)
+
+    except (OSError, ValueError):
+        return {}
+
+
+def get_managepy_file(folder=None):
+    folder = os.path.abspath(folder or os.getcwd())
+    ignore = [*MANAGEPY_IGNORE, *args.search_ignore]
+    options = [args.search_depth, ignore]
+
+    cache = load_managepy_cache()
+    cached = cache.get(folder)
+
+    try:
+        # A miss is never cached: a manage.py could appear deeper without touching this folder's mtime
+        if cached and cached['options'] == options and cached['mtime'] == os.stat(folder).st_mtime:
+            if cached['location_mtime'] == os.stat(os.path.dirname(cached['location'])).st_mtime:
+                return cached['location']
+
+    except OSError:
+        pass
+
+    location = search_managepy(folder, args.search_depth, ignore)
+
+    if not location:
+        return location
+
+    try:
+        cache[folder] = {
+            'options': options,
+            'mtime': os.stat(folder).st_mtime,
+            'location': location,
+            'location_mtime': os.stat(os.path.dirname(location)).st_mtime,
+        }
+
+        os.makedirs(STATE_DIR, exist_ok=True)
+        with NamedTemporaryFile('w', dir=STATE_DIR, delete=False) as temp:
+            json.dump(cache, temp)
+
+        os.replace(temp.name, MANAGEPY_CACHE_FILE)
+
+    except OSError:
+        pass
+
+    return location
+
+
+def proxy_url(host):
+    return '{}://{}'.format('http' if args.use_nginx else 'https', host)
+
+
+def probe_tcp(ip, port):
+    try:
+        socket.create_connection((ip, int(port)), timeout=1).close()
+        return True
+
+    except OSError:
+        return False
+
+
+def unverified_ssl_context():
+    import ssl
+
+    # The proxy serves local certificates the system may not trust, only reachability matters here
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def probe_http(host):
+    import http.client
+
+    if args.use_nginx:
+        connection = http.client.HTTPConnection(host, timeout=2)
+
+    else:
+        connection = http.client.HTTPSConnection(host, timeout=2, context=unverified_ssl_context())
+
+    try:
+        connection.request('HEAD', '/')
+        # 502/503/504 come from the proxy while the upstream is not ready yet
+        return connection.getresponse().status < 500
+
+    except OSError:
+        return False
+
+    finally:
+        connection.close()
+
+
+def wait_until_ready(ip, host=None, timeout=None, timings=None):
+    timeout = timeout or args.ready_timeout
+    start = time.monotonic()
+    probes = [('runserver_listen', lambda: probe_tcp(ip, BASE_PORT))]
+    if host:
+        probes.append(('first_response', lambda: probe_http(host)))
+
+    for name, probe in probes:
+        delay = READINESS_INITIAL_DELAY
+        probe_start = time.monotonic()
+
+        while not probe():
+            if time.monotonic() - start > timeout:
+                pprint('{} not ready after {:.0f}s'.format(host or ip, timeout), Mode.FAIL)
+                return None
+
+            time.sleep(delay)
+            delay = min(delay * 2, READINESS_MAX_DELAY)
+
+        if timings is not None:
+            timings[name] = time.monotonic() - probe_start
+
+    elapsed = time.monotonic() - start
+    pprint('{} ready in {:.2f}s'.format(host or ip, elapsed))
+
+    return elapsed
+
+
+def is_django_active(ip):
+    return lookup_django('{}:{}'.format(ip, BASE_PORT)) is not None
+
+
+class PreRunStep:
+
+    def __init__(self, name, command, requires=(), required=True):
+        self.name = name
+        self.command = command
+        self.requires = requires
+        self.required = required
+
+
+def project_fingerprint(project_dir):
+    digest = hashlib.sha256()
+
+    head = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=project_dir, capture_output=True, text=True)
+    digest.update(head.stdout.strip().encode('utf-8'))
+
+    ignore = [*MANAGEPY_IGNORE, *args.search_ignore]
+    for root, dirs, files in os.walk(project_dir):
+        dirs[:] = sorted(d for d in dirs if not any(fnmatch.fnmatch(d, pattern) for pattern in ignore))
+        folder = os.path.basename(root)
+
+        for name in sorted(files):
+            if name.endswith('.py') and (folder in ('migrations', 'settings') or name.startswith('settings')):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                digest.update('{}:{}:{}'.format(path, stat.st_mtime_ns, stat.st_size).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def discover_static_paths(managepy, python='python'):
+    completed = subprocess.run(
+        [python, managepy, 'shell', '-c', STATIC_SETTINGS_SCRIPT],
+        cwd=os.path.dirname(os.path.abspath(managepy)), capture_output=True, text=True, timeout=STATIC_SETTINGS_TIMEOUT,
+    )
+
+    if completed.returncode:
+        pprint('Could not read STATIC_ROOT and MEDIA_ROOT, runserver keeps serving them', Mode.WARNING)
+        return []
+
+    static_paths = []
+    for url, root in json.loads(completed.stdout.strip().splitlines()[-1]):
+        if not url or url.startswith(('http://', 'https://', '//')) or not root or not os.path.isdir(root):
+            continue
+
+        url = '/{}'.format(url.strip('/'))
+        if url != '/':
+            static_paths.append([url, os.path.abspath(root)])
+
+    return static_paths
+
+
+def refresh_static_paths(host, managepy, python='python', fingerprint=None):
+    if args.static_proxy is not None:
+        save_host_options(host, static_proxy=args.static_proxy)
+
+    if not host_options(host).get('static_proxy'):
+        return save_host_options(host, static_paths=[], static_fingerprint=None)
+
+    fingerprint = fingerprint or project_fingerprint(os.path.dirname(os.path.abspath(managepy)))
+    if host_options(host).get('static_fingerprint') == fingerprint:
+        return False
+
+    try:
+        static_paths = discover_static_paths(managepy, python)
+
+    except (subprocess.TimeoutExpired, ValueError, IndexError):
+        pprint('Could not read STATIC_ROOT and MEDIA_ROOT, runserver keeps serving them', Mode.WARNING)
+        static_paths = []
+
+    for url, root in static_paths:
+        pprint('Proxy serves {} from {}'.format(url, root), Mode.INFO)
+
+    return save_host_options(host, static_paths=static_paths, static_fingerprint=fingerprint)
+
+
+def sort_pre_run_steps(steps):
+    by_name = {step.name: step for step in steps}
+    ordered, seen = [], set()
+
+    def visit(step, chain=()):
+        if step.name in chain:
+            raise ValueError('Pre-run steps dependency cycle: {}'.format(' -> '.join([*chain, step.name])))
+
+        if step.name in seen:
+            return
+
+        for name in step.requires:
+            if name not in by_name:
+                raise ValueError('Pre-run step {} requires unknown step {}'.format(step.name, name))
+
+            visit(by_name[name], (*chain, step.name))
+
+        seen.add(step.name)
+        ordered.append(step)
+
+    for step in steps:
+        visit(step)
+
+    return ordered
+
+
+def run_pre_run_pipeline(steps, project_dir, fingerprint=None):
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not steps:
+        return
+
+    steps = sort_pre_run_steps([step if isinstance(step, PreRunStep) else PreRunStep(step, step) for step in steps])
+    fingerprint = fingerprint or project_fingerprint(project_dir)
+
+    try:
+        with open(PRE_RUN_CACHE_FILE, 'r') as cache_file:
+            cache = json.load(cache_file)
+
+    except (OSError, ValueError):
+        cache = {}
+
+    cache_lock = threading.Lock()
+    futures = {}
+
+    def run_step(step):
+        for name in step.requires:
+            if not futures[name].result():
+                pprint('Skipping {}, {} failed'.format(step.name, name), Mode.WARNING)
+                return False
+
+        key = '{}:{}'.format(project_dir, step.name)
+        digest = hashlib.sha256('{}\n{}'.format(step.command, fingerprint).encode('utf-8')).hexdigest()
+
+        if cache.get(key) == digest and not args.no_pre_run_cache:
+            pprint('Inputs unchanged, skipping: {}'.format(step.command), Mode.INFO)
+            return True
+
+        pprint("Running command: {}".format(step.command))
+        if subprocess.call(shlex.split(step.command)) != 0:
+            pprint('Command failed: {}'.format(step.command), Mode.FAIL)
+            return False
+
+        with cache_lock:
+            cache[key] = digest
+
+            os.makedirs(STATE_DIR, exist_ok=True)
+            with NamedTemporaryFile('w', dir=STATE_DIR, delete=False) as temp:
+                json.dump(cache, temp)
+
+            os.replace(temp.name, PRE_RUN_CACHE_FILE)
+
+        return True
+
+    # One thread per step: steps only block on their own dependencies, which are submitted first
+    executor = ThreadPoolExecutor(max_workers=len(steps))
+    for step in steps:
+        futures[step.name] = executor.submit(run_step, step)
+
+    for step in steps:
+        if step.required:
+            futures[step.name].result()
+
+    executor.shutdown(wait=False)
+
+
+class RotatingLog:
+
+    def __init__(self, name):
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.path = os.path.join(LOG_DIR, '{}.log'.format(name))
+        self.file = open(self.path, 'ab')
+
+    def rotate(self):
+        self.file.close()
+
+        for number in range(LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists('{}.{}'.format(self.path, number)):
+                os.replace('{}.{}'.format(self.path, number), '{}.{}'.format(self.path, number + 1))
+
+        os.replace(self.path, '{}.1'.format(self.path))
+        self.file = open(self.path, 'ab')
+
+    def write(self, data):
+        if self.file.tell() + len(data) > LOG_MAX_BYTES:
+            self.rotate()
+
+        self.file.write(data)
+        self.file.flush()
+
+
+class OutputPump(threading.Thread):
+
+    def __init__(self):
+        import selectors
+
+        super().__init__(daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ)
+        self.pending = []
+        self.open_streams = 0
+        self.condition = threading.Condition()
+
+    def add(self, stream, log, echo=False):
+        os.set_blocking(stream.fileno(), False)
+
+        with self.condition:
+            self.pending.append((stream, log, echo))
+            self.open_streams += 1
+
+        os.write(self.wakeup_write, b'\0')
+
+    def wait_closed(self, timeout=5):
+        with self.condition:
+            self.condition.wait_for(lambda: self.open_streams == 0, timeout)
+
+    def run(self):
+        import selectors
+
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj == self.wakeup_read:
+                    os.read(self.wakeup_read, 1024)
+
+                    with self.condition:
+                        for stream, log, echo in self.pending:
+                            self.selector.register(stream, selectors.EVENT_READ, (log, echo))
+
+                        self.pending = []
+
+                    continue
+
+                log, echo = key.data
+                try:
+                    data = os.read(key.fileobj.fileno(), 65536)
+
+                except BlockingIOError:
+                    continue
+
+                if not data:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+                    with self.condition:
+                        self.open_streams -= 1
+                        self.condition.notify_all()
+
+                    continue
+
+                log.write(data)
+                if echo:
+                    sys.stdout.buffer.write(data)
+                    sys.stdout.buffer.flush()
+
+
+_logs = {}
+
+
+def get_log(name):
+    if name not in _logs:
+        _logs[name] = RotatingLog(name)
+
+    return _logs[name]
+
+
+_output_pump = None
+
+
+def get_output_pump():
+    global _output_pump
+
+    if _output_pump is None:
+        _output_pump = OutputPump()
+        _output_pump.start()
+
+    return _output_pump
+
+
+def unbuffered_environ():
+    # stdout is a pipe, without this python children buffer their output until exit
+    return {**os.environ, 'PYTHONUNBUFFERED': '1'}
+
+
+def spawn_logged(command, log_name, echo=False, **kwargs):
+    kwargs.setdefault('env', unbuffered_environ())
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+    get_output_pump().add(process.stdout, get_log(log_name), echo)
+
+    return process
+
+
+def follow_logs(patterns):
+    followed = {}
+
+    def discover():
+        try:
+            names = sorted(os.listdir(LOG_DIR))
+
+        except FileNotFoundError:
+            names = []
+
+        for name in names:
+            if name.endswith('.log') and name not in followed and any(name.startswith(pattern) for pattern in patterns):
+                path = os.path.join(LOG_DIR, name)
+
+                with open(path, 'rb') as log:
+                    tail = log.read().splitlines()[-LOG_TAIL_LINES:]
+                    position = log.tell()
+
+                followed[name] = {'path': path, 'position': position, 'inode': os.stat(path).st_ino}
+                for line in tail:
+                    print_log_line(name, line)
+
+    discover()
+    if not followed:
+        pprint('No log found for {} in {}'.format(', '.join(patterns), LOG_DIR), Mode.WARNING)
+
+    # Regular files are always "readable" for select, so the files are polled by size from this single loop
+    while True:
+        for name, state in followed.items():
+            try:
+                stat = os.stat(state['path'])
+
+            except FileNotFoundError:
+                continue
+
+            if stat.st_ino != state['inode'] or stat.st_size < state['position']:
+                state['inode'], state['position'] = stat.st_ino, 0
+
+            if stat.st_size == state['position']:
+                continue
+
+            with open(state['path'], 'rb') as log:
+                log.seek(state['position'])
+                data = log.read()
+
+            # Keep an incomplete last line for the next round
+            complete = data[:data.rfind(b'\n') + 1]
+            state['position'] += len(complete)
+
+            for line in complete.splitlines():
+                print_log_line(name, line)
+
+        time.sleep(LOG_POLL_INTERVAL)
+        discover()
+
+
+def print_log_line(name, line):
+    print('{}[{}]{} {}'.format(Mode.OPERATION.value, name[:-len('.log')], Mode.NORMAL.value, line.decode('utf-8', 'replace')), flush=True)
+
+
+def build_runserver_command(managepy_location, endpoint, args=(), with_debug=False, wait_for_client=True, python='python', port=BASE_PORT):
+    command = [python, managepy_location, 'runserver', '{}:{}'.format(endpoint, port), *args]
+    if with_debug:
+        command = [python, "-m", "debugpy", "--wait-for-client", "--listen", f"{endpoint}:5678", managepy_location, "runserver", f"{endpoint}:{port}", *args]
+
+        if not wait_for_client:
+            command.pop(3)
+
+    return command
+
+
+class FileWatcher(threading.Thread):
+
+    def __init__(self, root):
+        import ctypes
+
+        super().__init__(daemon=True)
+        self.root = root
+        self.ignore = [*MANAGEPY_IGNORE, *args.search_ignore]
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.directories = {}
+
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        self.watch_tree(root)
+
+    def watch_tree(self, top):
+        import ctypes
+
+        for root, dirs, _ in os.walk(top):
+            dirs[:] = [d for d in dirs if not any(fnmatch.fnmatch(d, pattern) for pattern in self.ignore)]
+
+            descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(root), INOTIFY_MASK)
+            if descriptor < 0:
+                # ENOSPC here means fs.inotify.max_user_watches is too low for the tree
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), root)
+
+            self.directories[descriptor] = root
+
+    def add(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def remove(self, callback):
+        with self.lock:
+            self.callbacks.remove(callback)
+
+    def read_events(self):
+        data = os.read(self.fd, 65536)
+        changed = False
+        offset = 0
+
+        while offset < len(data):
+            descriptor, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b'\0'))
+            offset += 16 + length
+
+            if mask & INOTIFY_OVERFLOW:
+                changed = True
+
+            elif mask & INOTIFY_IGNORED:
+                self.directories.pop(descriptor, None)
+
+            elif mask & INOTIFY_ISDIR:
+                if descriptor in self.directories and not any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore):
+                    if mask & INOTIFY_CREATED:
+                        self.watch_tree(os.path.join(self.directories[descriptor], name))
+
+                    changed = True
+
+            elif any(fnmatch.fnmatch(name, pattern) for pattern in RELOAD_PATTERNS):
+                changed = True
+
+        return changed
+
+    def run(self):
+        import selectors
+
+        selector = selectors.DefaultSelector()
+        selector.register(self.fd, selectors.EVENT_READ)
+        deadline = None
+
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+
+            if selector.select(timeout):
+                try:
+                    if self.read_events():
+                        # Every new event pushes the restart back, so a checkout gives a single restart
+                        deadline = time.monotonic() + RELOAD_DEBOUNCE
+
+                except OSError as error:
+                    pprint('File watcher for {} failed: {}'.format(self.root, error), Mode.WARNING)
+
+                continue
+
+            deadline = None
+            with self.lock:
+                callbacks = list(self.callbacks)
+
+            for callback in callbacks:
+                callback()
+
+
+_file_watchers = {}
+
+
+def get_file_watcher(root):
+    root = os.path.realpath(root)
+
+    if root not in _file_watchers:
+        _file_watchers[root] = FileWatcher(root)
+        _file_watchers[root].start()
+
+    return _file_watchers[root]
+
+
+def django_server_activate(managepy_location, endpoint, commands=[], args=(), kwargs=None, on_spawn=None, ports=None, log_name=None, fingerprint=None):
+    project_dir = os.path.dirname(os.path.abspath(managepy_location))
+
+    with timed_phase('pre_run'):
+        run_pre_run_pipeline(commands, project_dir, fingerprint)
+
+    watcher = None
+    if kwargs.inotify_reload:
+        try:
+            watcher = get_file_watcher(project_dir)
+
+        except (OSError, AttributeError) as error:
+            pprint("inotify unavailable ({}), keeping Django's stat reloader".format(error), Mode.WARNING)
+
+    location = short_location(shutil.which('python') or 'python')
+    processes = {}
+    lock = threading.Lock()
+    stopping = threading.Event()
+
+    def spawn():
+        for port in ports or [BASE_PORT]:
+            # Only one process can hold the debugger port, the first one
+            with_debug = kwargs.with_debug and port == (ports or [BASE_PORT])[0]
+            command = build_runserver_command(managepy_location, endpoint, [*args, *(['--noreload'] if watcher else []), *uargs], with_debug, not kwargs.no_wait_for_client, port=port)
+
+            bind = '{}:{}'.format(endpoint, port)
+            processes[bind] = spawn_logged(command, log_name or endpoint, echo=True)
+            register_django(bind, processes[bind].pid, location)
+
+    def restart():
+        with lock:
+            if stopping.is_set():
+                return
+
+            pprint('Change detected in {}, restarting runserver'.format(project_dir), Mode.OPERATION)
+            for bind, process in processes.items():
+                if process.poll() is None:
+                    process.terminate()
+
+            for bind, process in processes.items():
+                process.wait()
+                unregister_django(bind, process.pid)
+
+            spawn()
+
+    spawn()
+
+    if on_spawn:
+        on_spawn(processes)
+
+    if watcher:
+        watcher.add(restart)
+
+    try:
+        if watcher:
+            # A crashed runserver comes back on the next change, so only Ctrl-C ends a watched launch
+            with contextlib.suppress(KeyboardInterrupt):
+                while True:
+                    signal.pause()
+
+        else:
+            for process in processes.values():
+                try:
+                    process.wait()
+
+                except KeyboardInterrupt:
+                    process.wait()
+
+    finally:
+        with lock:
+            stopping.set()
+
+        if watcher:
+            watcher.remove(restart)
+
+        for bind, process in processes.items():
+            if process.poll() is None:
+                process.terminate()
+
+            unregister_django(bind, process.pid)
+
+        get_output_pump().wait_closed()
+
+
+class LazyServer:
+
+    def __init__(self, ip, command, log_name, idle_timeout):
+        import asyncio
+
+        self.ip = ip
+        self.backend_port = int(BASE_PORT) + LAZY_PORT_OFFSET
+        self.command = command
+        self.log_name = log_name
+        self.idle_timeout = idle_timeout
+        self.process = None
+        self.connections = 0
+        self.last_activity = time.monotonic()
+        self.starting = asyncio.Lock()
+
+    def backend_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    async def backend_listening(self):
+        import asyncio
+
+        try:
+            _, writer = await asyncio.open_connection(self.ip, self.backend_port)
+
+        except OSError:
+            return False
+
+        writer.close()
+        return True
+
+    async def ensure_backend(self):
+        import asyncio
+
+        async with self.starting:
+            if self.backend_alive():
+                return True
+
+            pprint('Connection on {}:{}, starting runserver'.format(self.ip, BASE_PORT), Mode.OPERATION)
+            start = time.monotonic()
+            self.process = spawn_logged(self.command, self.log_name, echo=True, start_new_session=True)
+
+            while not await self.backend_listening():
+                if not self.backend_alive() or time.monotonic() - start > args.ready_timeout:
+                    pprint('runserver did not come up', Mode.FAIL)
+                    return False
+
+                await asyncio.sleep(0.1)
+
+            pprint('runserver ready in {:.2f}s'.format(time.monotonic() - start))
+            return True
+
+    async def pipe(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+
+                writer.write(data)
+                await writer.drain()
+                self.last_activity = time.monotonic()
+
+            if writer.can_write_eof():
+                writer.write_eof()
+
+        except OSError:
+            writer.close()
+
+    async def handle(self, reader, writer):
+        import asyncio
+
+        self.connections += 1
+
+        try:
+            if await self.ensure_backend():
+                upstream_reader, upstream_writer = await asyncio.open_connection(self.ip, self.backend_port)
+                await asyncio.gather(self.pipe(reader, upstream_writer), self.pipe(upstream_reader, writer))
+                upstream_writer.close()
+
+        except OSError:
+            pass
+
+        finally:
+            self.connections -= 1
+            self.last_activity = time.monotonic()
+            writer.close()
+
+    async def stop_backend(self):
+        import asyncio
+
+        if self.backend_alive():
+            signal_process_group(self.process, signal.SIGTERM)
+            await asyncio.to_thread(self.process.wait)
+
+        self.process = None
+
+    async def watch_idle(self):
+        import asyncio
+
+        while True:
+            await asyncio.sleep(LAZY_IDLE_CHECK)
+
+            if self.backend_alive() and not self.connections and time.monotonic() - self.last_activity > self.idle_timeout * 60:
+                pprint('No traffic for {:.0f} minutes, stopping runserver until the next connection'.format(self.idle_timeout), Mode.INFO)
+                await self.stop_backend()
+
+    async def serve(self):
+        import asyncio
+
+        bind = '{}:{}'.format(self.ip, BASE_PORT)
+        server = await asyncio.start_server(self.handle, self.ip, int(BASE_PORT))
+        register_process(bind, os.getpid(), kind='lazy', ip=bind, location=self.log_name)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        pprint('Listening on {}, runserver starts on the first connection'.format(bind), Mode.OPERATION)
+        watcher = asyncio.ensure_future(self.watch_idle())
+
+        try:
+            async with server:
+                await stop.wait()
+
+        finally:
+            watcher.cancel()
+            await self.stop_backend()
+            unregister_process(bind, os.getpid())
+
+
+def lazy_server_activate(managepy_location, endpoint, commands=[], args=(), log_name=None, idle_timeout=LAZY_IDLE_TIMEOUT, fingerprint=None):
+    import asyncio
+
+    with timed_phase('pre_run'):
+        run_pre_run_pipeline(commands, os.path.dirname(os.path.abspath(managepy_location)), fingerprint)
+
+    command = build_runserver_command(managepy_location, endpoint, [*args, *uargs], port=str(int(BASE_PORT) + LAZY_PORT_OFFSET))
+    asyncio.run(LazyServer(endpoint, command, log_name or endpoint, idle_timeout).serve())
+
+
+def load_stack_manifest(path):
+    try:
+        import tomllib
+
+    except ImportError:
+        import tomli as tomllib
+
+    with open(path, 'rb') as manifest:
+        services = tomllib.load(manifest).get('service', [])
+
+    for service in services:
+        service['path'] = os.path.abspath(os.path.expanduser(service.get('path', '.')))
+        service['python'] = os.path.expanduser(service.get('python', 'python'))
+        service['endpoint'] = service.get('raw_name') or SERVER_NAME_FORMAT.format(service['name'])
+        service['managepy'] = get_managepy_file(service['path'])
+
+    return services
+
+
+def signal_process_group(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+
+    except ProcessLookupError:
+        pass
+
+
+async def stream_output(prefix, stream, log):
+    async for line in stream:
+        log.write(line)
+        print('{} {}'.format(prefix, line.decode('utf-8', 'replace').rstrip()), flush=True)
+
+
+async def supervise_stack(launches):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    running = {}
+    waiters = {}
+    pipes = []
+
+    async def start(index):
+        prefix, command, cwd, log_name, _ = launches[index]
+
+        # Own process group, so the autoreloader child is stopped along with its parent
+        process = await asyncio.create_subprocess_exec(
+            *command, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, start_new_session=True, env=unbuffered_environ(),
+        )
+        running[index] = process
+        waiters[asyncio.ensure_future(process.wait())] = index
+        pipes.append(asyncio.ensure_future(stream_output(prefix, process.stdout, get_log(log_name))))
+
+        if 'runserver' in command:
+            register_django(command[command.index('runserver') + 1], process.pid, short_location(shutil.which(command[0]) or command[0]))
+
+    async def restart(root):
+        restarted = [index for index, launch in enumerate(launches) if launch[4] == root]
+        pprint('Change detected in {}, restarting {} process(es)'.format(root, len(restarted)), Mode.OPERATION)
+
+        for index in restarted:
+            signal_process_group(running[index], signal.SIGTERM)
+
+        stopped = [waiter for waiter, index in waiters.items() if index in restarted]
+        _, still_running = await asyncio.wait(stopped, timeout=STACK_SHUTDOWN_TIMEOUT)
+        for waiter in still_running:
+            signal_process_group(running[waiters[waiter]], signal.SIGKILL)
+
+        await asyncio.wait(stopped)
+
+        for waiter in stopped:
+            index = waiters.pop(waiter)
+            command = launches[index][1]
+
+            if 'runserver' in command:
+                unregister_django(command[command.index('runserver') + 1], running[index].pid)
+
+            await start(index)
+
+    for index in range(len(launches)):
+        await start(index)
+
+    # One callback per watched tree, every process of that tree restarts together
+    changes = asyncio.Queue()
+    callbacks = {}
+    for root in {launch[4] for launch in launches if launch[4]}:
+        callbacks[root] = functools.partial(loop.call_soon_threadsafe, changes.put_nowait, root)
+        get_file_watcher(root).add(callbacks[root])
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    stopper = asyncio.ensure_future(stop.wait())
+    changed = asyncio.ensure_future(changes.get())
+
+    # Keep running until asked to stop, or until every process is gone; a crashed watched process comes back on the next change
+    pending = set(waiters)
+    while (pending or callbacks) and not stop.is_set():
+        done, _ = await asyncio.wait(pending | {stopper, changed}, return_when=asyncio.FIRST_COMPLETED)
+
+        for waiter in done & pending:
+            pprint('{} exited with code {}'.format(launches[waiters[waiter]][0], waiter.result()), Mode.WARNING)
+
+        pending -= done
+
+        if changed in done and not stop.is_set():
+            await restart(changed.result())
+            changed = asyncio.ensure_future(changes.get())
+            pending = {waiter for waiter in waiters if not waiter.done()}
+
+    for root, callback in callbacks.items():
+        get_file_watcher(root).remove(callback)
+
+    pprint('Stopping the stack ...', Mode.OPERATION)
+    for process in running.values():
+        signal_process_group(process, signal.SIGTERM)
+
+    _, still_running = await asyncio.wait(waiters, timeout=STACK_SHUTDOWN_TIMEOUT)
+
+    if still_running:
+        for index, process in running.items():
+            if process.returncode is None:
+                pprint('{} did not stop in time, killing it'.format(launches[index][0]), Mode.WARNING)
+                signal_process_group(process, signal.SIGKILL)
+
+        await asyncio.wait(still_running)
+
+    stopper.cancel()
+    changed.cancel()
+    await asyncio.gather(*pipes, return_exceptions=True)
+
+    for index, process in running.items():
+        command = launches[index][1]
+        if 'runserver' in command:
+            unregister_django(command[command.index('runserver') + 1], process.pid)
+
+
+def command_stack():
+    import asyncio
+
+    services = load_stack_manifest(args.stack)
+
+    for service in services:
+        if not service['managepy']:
+            pprint('No manage.py file found for {} in {}'.format(service['name'], service['path']), Mode.FAIL)
+            sys.exit(1)
+
+    active_hosts = get_managed_host()
+
+    for service in services:
+        if service['endpoint'] not in active_hosts:
+            choosen_ip = search_free_dev_ip(service['endpoint'])
+            if not choosen_ip:
+                sys.exit(1)
+
+            active_hosts[service['endpoint']] = choosen_ip
+
+        service['ip'] = active_hosts[service['endpoint']]
+        if 'workers' in service:
+            save_host_options(service['endpoint'], workers=service['workers'])
+
+        refresh_static_paths(service['endpoint'], service['managepy'], service['python'])
+        pprint('{} @ {}'.format(service['endpoint'], service['ip']))
+
+    # One hosts write and one proxy reload for the whole stack
+    with privileged_batch():
+        update_managed_host(active_hosts)
+        update_proxy_config(active_hosts)
+
+    colors = itertools.cycle([Mode.OK, Mode.OPERATION, Mode.INFO, Mode.INTEROGATION])
+    launches = []
+
+    for service in services:
+        if is_django_active(service['ip']):
+            pprint('{} is already running, skipping'.format(service['endpoint']), Mode.WARNING)
+            continue
+
+        # Services sharing a tree share its watcher, see get_file_watcher
+        watch = None
+        if args.inotify_reload:
+            try:
+                get_file_watcher(service['path'])
+                watch = os.path.realpath(service['path'])
+
+            except (OSError, AttributeError) as error:
+                pprint("inotify unavailable for {} ({}), keeping Django's stat reloader".format(service['name'], error), Mode.WARNING)
+
+        color = next(colors).value
+        prefix = '{}[{}]{}'.format(color, service['name'], Mode.NORMAL.value)
+        for port in worker_ports(service['endpoint']):
+            command = build_runserver_command(service['managepy'], service['ip'], [*service.get('args', []), *(['--noreload'] if watch else [])], python=service['python'], port=port)
+            launches.append((prefix, command, service['path'], service['endpoint'], watch))
+
+        if service.get('celery'):
+            worker_name = 'worker-{}'.format(service['name'])
+            celery = [service['python'], '-m', 'celery', '-A', service.get('celery_app', 'app'), 'worker', '-l', 'info', '-E', '-n', worker_name]
+            launches.append(('{}[{}:celery]{}'.format(color, service['name'], Mode.NORMAL.value), celery, service['path'], '{}.celery'.format(service['endpoint']), None))
+
+    if not launches:
+        pprint('Nothing to launch', Mode.INFO)
+        return
+
+    pprint('Launching {} process(es), Ctrl-C to stop them all'.format(len(launches)), Mode.OPERATION)
+    asyncio.run(supervise_stack(launches))
+
+
+def build_status(hosts, by_bind, celery=None, proxy_hosts=None):
+    now = time.time()
+
+    celery_by_host = {}
+    for entry in (celery or {}).values():
+        celery_by_host.setdefault(entry['host'], []).append({'kind': entry['kind'], 'pid': entry['pid']})
+
+    status = []
+    managed_binds = set()
+
+    for host, ip in hosts.items():
+        ports = worker_ports(host)
+        binds = ['{}:{}'.format(ip, port) for port in ports]
+        managed_binds.update(binds)
+
+        running = [by_bind[bind] for bind in binds if bind in by_bind]
+        server = running[0] if running else None
+
+        status.append({
+            'host': host,
+            'ip': ip,
+            'port': int(ports[0]),
+            'ports': [int(port) for port in ports],
+            'running': server is not None,
+            'pid': server['pid'] if server else None,
+            'pids': [entry['pid'] for entry in running],
+            'location': server['location'] if server else None,
+            'uptime': round(now - server['create_time'], 1) if server else None,
+            'proxy': host in proxy_hosts if proxy_hosts is not None else None,
+            'celery': celery_by_host.get(host, []),
+        })
+
+    for bind, server in by_bind.items():
+        if bind in managed_binds:
+            continue
+
+        ip, _, port = bind.rpartition(':')
+        status.append({
+            'host': None,
+            'ip': ip,
+            'port': int(port) if port.isdigit() else None,
+            'ports': [int(port)] if port.isdigit() else [],
+            'running': True,
+            'pid': server['pid'],
+            'pids': [server['pid']],
+            'location': server['location'],
+            'uptime': round(now - server['create_time'], 1),
+            'proxy': None,
+            'celery': [],
+        })
+
+    return status
+
+
+def get_status():
+    return build_status(
+        get_managed_host(),
+        build_process_index()['by_bind'],
+        get_celery_processes(),
+        set(get_proxy_backend().read_fragment_hashes()),
+    )
+
+
+def show_managed(active_hosts, by_bind, celery=None):
+    pprint('Managed hosts: ', Mode.OPERATION)
+
+    for host, ip in active_hosts.items():
+
+        text = '{} @ {}'.format(host, ip)
+        pprint(text)
+
+    pprint('Found running django servers: ', Mode.OPERATION)
+    for django_ip, running_django in by_bind.items():
+
+        pprint(running_django['location'], continuous=True, end='')
+        pprint(" : with IP: http://", Mode.OPERATION, continuous=True, end='')
+        pprint(django_ip, continuous=True)
+
+    pprint('Normaly, those are correct and running:', Mode.OPERATION)
+
+    for host, ip in active_hosts.items():
+        running_django = by_bind.get('{}:{}'.format(ip, BASE_PORT))
+        if running_django:
+            pprint('{}{}{} - {}{: <30}{} => {}(env){} {}{}{}'.format(
+                Mode.BOLD.value,
+                ip,
+                Mode.NORMAL.value,
+                Mode.INFO.value,
+                host,
+                Mode.NORMAL.value,
+                Mode.BOLD.value,
+                Mode.NORMAL.value,
+                Mode.OPERATION.value,
+                running_django['location'],
+                Mode.NORMAL.value
+            ))
+
+    if celery:
+        pprint('Celery processes:', Mode.OPERATION)
+
+        for key, entry in sorted(celery.items()):
+            pprint('{: <8} {: <30} pid {}'.format(entry['kind'], entry['host'], entry['pid']))
+
+
+def remove_matching_hosts(active_hosts, patterns):
+    remaining = copy.deepcopy(active_hosts)
+
+    for to_remove in patterns:
+        for host, ip in active_hosts.items():
+            # Remove if name match, or ip
+            if (to_remove.lower() in host or to_remove.lower() in ip) and host in remaining:
+                pprint("Removing {} with ip {}".format(host, ip))
+
+                remaining.pop(host, None)
+
+    return remaining
+
+
+def erase_hosts(active_hosts, names):
+    remaining = dict(active_hosts)
+
+    for to_be_erased in names:
+        if remaining.get(to_be_erased):
+            remaining.pop(to_be_erased)
+            pprint(f"Removing {to_be_erased} from /etc/hosts and nginx config")
+
+    return remaining
+
+
+class DjangoRunDaemon:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index_time = 0
+
+    def hosts(self):
+        return get_managed_host()
+
+    def servers(self):
+        if time.time() - self.index_time > PROCESS_INDEX_TTL:
+            self.index_time = time.time()
+            return build_process_index(refresh=True)['by_bind']
+
+        return build_process_index()['by_bind']
+
+    def apply(self, hosts, force=False):
+        with privileged_batch():
+            update_managed_host(hosts)
+            update_proxy_config(hosts, force=force)
+
+        return {'hosts': get_managed_host()}
+
+    def handle(self, request):
+        handler = getattr(self, 'command_{}'.format(request.get('command')), None)
+
+        if handler is None:
+            return {'error': 'Unknown command {}'.format(request.get('command'))}
+
+        if request.get('command') != 'ping' and request.get('options', {}) != daemon_options():
+            return {'mismatch': daemon_options()}
+
+        return handler(**request.get('params', {}))
+
+    def command_ping(self):
+        return {'pid': os.getpid()}
+
+    def command_managed(self):
+        return {'hosts': self.hosts(), 'servers': self.servers(), 'celery': get_celery_processes()}
+
+    def command_status(self):
+        return {'status': build_status(self.hosts(), self.servers(), get_celery_processes(), set(get_proxy_backend().read_fragment_hashes()))}
+
+    def command_config(self):
+        return {'config': create_proxy_config(self.hosts())}
+
+    def command_erase(self, names):
+        with self.lock:
+            hosts = self.hosts()
+            remaining = erase_hosts(hosts, names)
+
+            return {**self.apply(remaining), 'removed': {host: ip for host, ip in hosts.items() if host not in remaining}}
+
+    def command_remove(self, patterns, apply=False):
+        with self.lock:
+            hosts = self.hosts()
+            remaining = remove_matching_hosts(hosts, patterns)
+            removed = {host: ip for host, ip in hosts.items() if host not in remaining}
+
+            if not apply:
+                return {'hosts': remaining, 'removed': removed}
+
+            return {**self.apply(remaining, force=True), 'removed': removed}
+
+    def command_reload(self):
+        with self.lock:
+            return self.apply(self.hosts(), force=True)
+
+    def command_allocate(self, host):
+        with self.lock:
+            hosts = self.hosts()
+
+            if host in hosts:
+                self.apply(hosts)
+                return {'ip': hosts[host], 'created': False}
+
+            choosen_ip = search_free_dev_ip(host)
+            if not choosen_ip:
+                return {'error': 'No free ip left'}
+
+            hosts = self.hosts()
+            hosts[host] = choosen_ip
+            self.apply(hosts)
+
+            return {'ip': choosen_ip, 'created': True}
+
+
+def handle_daemon_connection(connection, client_address, server):
+    with connection.makefile('rb') as rfile, connection.makefile('wb', buffering=0) as wfile:
+        for line in rfile:
+            try:
+                response = server.daemon.handle(json.loads(line))
+
+            except Exception as error:
+                response = {'error': '{}: {}'.format(error.__class__.__name__, error)}
+
+            wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+def serve_daemon():
+    import socketserver
+
+    os.makedirs(STATE_DIR, exist_ok=True)
+
+    if daemon_request('ping') is not None:
+        pprint('A django-run daemon is already running', Mode.FAIL)
+        sys.exit(1)
+
+    if os.path.exists(DAEMON_SOCKET):
+        os.remove(DAEMON_SOCKET)
+
+    server = socketserver.ThreadingUnixStreamServer(DAEMON_SOCKET, handle_daemon_connection)
+    server.daemon = DjangoRunDaemon()
+    server.daemon_threads = True
+    os.chmod(DAEMON_SOCKET, 0o600)
+
+    pprint('django-run daemon listening on {}'.format(DAEMON_SOCKET), Mode.OPERATION)
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+        os.remove(DAEMON_SOCKET)
+
+
+def daemon_options():
+    return {name: getattr(args, name) for name in DAEMON_OPTIONS}
+
+
+def daemon_request(command, **params):
+    if not os.path.exists(DAEMON_SOCKET):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(DAEMON_TIMEOUT)
+            sock.connect(DAEMON_SOCKET)
+            sock.sendall((json.dumps({'command': command, 'params': params, 'options': daemon_options()}) + '\n').encode('utf-8'))
+
+            with sock.makefile('r') as stream:
+                response = json.loads(stream.readline())
+
+    except (OSError, ValueError):
+        return None
+
+    if 'mismatch' in response:
+        pprint('Daemon runs with other options ({}), running locally'.format(', '.join(
+            name for name in DAEMON_OPTIONS if response['mismatch'].get(name) != getattr(args, name)
+        )), Mode.INFO)
+        return None
+
+    if 'error' in response:
+        pprint('Daemon: {}'.format(response['error']), Mode.FAIL)
+        sys.exit(1)
+
+    return response
+
+
+def run_daemon_client():
+    if args.managed and args.json:
+        response = daemon_request('status')
+        if response is None:
+            return False
+
+        print(json.dumps(response['status'], indent=2))
+
+    elif args.managed:
+        response = daemon_request('managed')
+        if response is None:
+            return False
+
+        show_managed(response['hosts'], response['servers'], response['celery'])
+
+    elif args.config:
+        response = daemon_request('config')
+        if response is None:
+            return False
+
+        if args.json:
+            print(json.dumps({'backend': get_proxy_backend().name, 'config': response['config']}, indent=2))
+            return True
+
+        pprint('Normal {} config file:'.format(get_proxy_backend().name), Mode.OPERATION)
+        pprint(response['config'], Mode.NORMAL, continuous=True)
+
+    elif args.remove:
+        response = daemon_request('remove', patterns=args.remove, apply=args.reload_config)
+        if response is None:
+            return False
+
+        # The daemon prints to its own terminal, so the removed hosts are shown again here
+        pprint("Following host will be erased:", Mode.WARNING)
+        for host, ip in response['removed'].items():
+            pprint("Removing {} with ip {}".format(host, ip))
+
+        if not args.reload_config:
+            pprint("No host realy removed, to apply change, use --reload-config to write down the config")
+
+    elif args.erase:
+        response = daemon_request('erase', names=args.erase)
+        if response is None:
+            return False
+
+        for host in response['removed']:
+            pprint(f"Removing {host} from /etc/hosts and nginx config")
+
+    elif args.reload_config:
+        if daemon_request('reload') is None:
+            return False
+
+    else:
+        return False
+
+    return True
+
+
+def clear_all():
+    with privileged_batch():
+        pprint('Removing /etc/hosts managed configs')
+        update_managed_host({})
+        pprint('Removing nginx managed config')
+        update_proxy_config({})
+
+
+def get_edited_hosts():
+    active_hosts = get_managed_host()
+
+    if args.remove:
+        pprint("Following host will be erased:", Mode.WARNING)
+        active_hosts = remove_matching_hosts(active_hosts, args.remove)
+
+        if not args.reload_config and not args.erase:
+            pprint("No host realy removed, to apply change, use --reload-config to write down the config")
+
+    return active_hosts
+
+
+def command_daemon():
+    serve_daemon()
+
+
+def command_startup_bench():
+    script = os.path.abspath(__file__)
+    results = []
+
+    for flags in STARTUP_BENCH_COMMANDS:
+        start = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', script, *flags, '--no-daemon'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+        )
+        wall = time.perf_counter() - start
+
+        imports = {}
+        for line in completed.stderr.split('\n'):
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+
+            _, cumulative, name = line[len('import time:'):].split('|')
+            # Top level imports only: nested ones are indented and already counted in their parent
+            if not name.startswith('  '):
+                imports[name.strip()] = int(cumulative)
+
+        results.append({
+            'command': ' '.join(flags),
+            'wall_ms': round(wall * 1000, 1),
+            'import_ms': round(sum(imports.values()) / 1000, 1),
+            'slowest': sorted(imports.items(), key=lambda item: item[1], reverse=True)[:5],
+        })
+
+    previous = {}
+    try:
+        with open(STARTUP_BENCH_FILE, 'r') as history:
+            for line in history:
+                entry = json.loads(line)
+                previous[entry['command']] = entry
+
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(STARTUP_BENCH_FILE, 'a') as history:
+        for result in results:
+            history.write(json.dumps({'time': time.time(), **result}) + '\n')
+
+    pprint('Startup time per subcommand:', Mode.OPERATION)
+    for result in results:
+        before = previous.get(result['command'])
+        delta = ' ({:+.1f} ms)'.format(result['wall_ms'] - before['wall_ms']) if before else ''
+
+        pprint('{: <30} wall {: >8.1f} ms{} | imports {: >8.1f} ms'.format(result['command'], result['wall_ms'], delta, result['import_ms']))
+        for name, cumulative in result['slowest']:
+            pprint('    {: <26} {: >8.1f} ms'.format(name, cumulative / 1000), Mode.INFO, continuous=True)
+
+
+def command_stats():
+    projects = {}
+
+    try:
+        with open(STARTUP_HISTORY_FILE, 'r') as history:
+            for line in history:
+                entry = json.loads(line)
+                projects.setdefault(entry['project'], []).append(entry)
+
+    except (OSError, ValueError):
+        pass
+
+    if not projects:
+        pprint('No startup recorded yet in {}'.format(STARTUP_HISTORY_FILE), Mode.INFO)
+        return
+
+    for project, entries in sorted(projects.items()):
+        pprint('{} ({} launches)'.format(project, len(entries)), Mode.OPERATION)
+
+        phases = {}
+        for entry in entries:
+            for name, duration in [*entry['phases'].items(), ('total', entry['total'])]:
+                phases.setdefault(name, []).append(duration)
+
+        for name, durations in phases.items():
+            pprint('    {: <20} p50 {: >8.3f}s  p90 {: >8.3f}s  p99 {: >8.3f}s  max {: >8.3f}s'.format(
+                name, percentile(durations, 50), percentile(durations, 90), percentile(durations, 99), max(durations),
+            ), continuous=True)
+
+
+def command_certs():
+    now = time.time()
+
+    for host in get_managed_host():
+        certificate = get_certificate(host)
+
+        if not certificate:
+            pprint('{: <40} no certificate'.format(host), Mode.WARNING)
+            continue
+
+        expiry = certificate_expiry(certificate[0])
+        if expiry is None:
+            pprint('{: <40} unreadable certificate {}'.format(host, certificate[0]), Mode.FAIL)
+
+        elif expiry - now < CERT_EXPIRY_WARNING_DAYS * 86400:
+            pprint('{: <40} expires in {:.0f} days'.format(host, (expiry - now) / 86400), Mode.WARNING)
+
+        else:
+            pprint('{: <40} expires in {:.0f} days'.format(host, (expiry - now) / 86400))
+
+
+def command_generate_certs():
+    active_hosts = get_managed_host()
+    to_renew = certificates_to_renew(active_hosts)
+
+    if not to_renew:
+        pprint('Every managed host has a valid certificate', Mode.INFO)
+        return
+
+    if generate_certificates(to_renew):
+        update_proxy_config(active_hosts)
+
+
+def command_logs():
+    try:
+        follow_logs(args.logs)
+
+    except KeyboardInterrupt:
+        pass
+
+
+def collect_host_processes():
+    by_bind = build_process_index(refresh=True)['by_bind']
+    roots = {}
+
+    for host, ip in get_managed_host().items():
+        for port in worker_ports(host):
+            bind = '{}:{}'.format(ip, port)
+
+            # The registered process is the autoreloader parent, the scan only finds its child
+            entry = get_registered_process(bind)
+            if not entry or not is_registered_alive(entry):
+                entry = by_bind.get(bind)
+
+            if entry:
+                roots.setdefault(host, {'servers': [], 'celery': []})['servers'].append(entry['pid'])
+
+    for entry in get_celery_processes().values():
+        roots.setdefault(entry['host'], {'servers': [], 'celery': []})['celery'].append(entry['pid'])
+
+    return roots
+
+
+def process_family(pid, cache):
+    import psutil
+
+    try:
+        root = cache.setdefault(pid, psutil.Process(pid))
+        return [root, *(cache.setdefault(child.pid, child) for child in root.children(recursive=True))]
+
+    except psutil.Error:
+        return []
+
+
+def sample_host(pids, cache):
+    import psutil
+
+    sample = {'cpu': 0.0, 'rss': 0, 'fds': 0, 'threads': 0, 'processes': 0, 'connections': 0}
+
+    for pid in pids:
+        for proc in process_family(pid, cache):
+            try:
+                with proc.oneshot():
+                    sample['cpu'] += proc.cpu_percent(None)
+                    sample['rss'] += proc.memory_info().rss
+                    sample['fds'] += proc.num_fds()
+                    sample['threads'] += proc.num_threads()
+
+                connections = proc.net_connections('tcp') if hasattr(proc, 'net_connections') else proc.connections('tcp')
+                sample['connections'] += sum(1 for connection in connections if connection.status == psutil.CONN_ESTABLISHED)
+                sample['processes'] += 1
+
+            except psutil.Error:
+                continue
+
+    return sample
+
+
+def last_log_activity(host):
+    try:
+        return os.stat(os.path.join(LOG_DIR, '{}.log'.format(host))).st_mtime
+
+    except OSError:
+        return 0
+
+
+def stop_host_processes(pids, cache):
+    import psutil
+
+    family = [proc for pid in pids for proc in process_family(pid, cache)]
+    for proc in family:
+        try:
+            proc.terminate()
+
+        except psutil.Error:
+            pass
+
+    psutil.wait_procs(family, timeout=5)
+
+
+def command_top():
+    cache = {}
+    started = time.time()
+    last_activity = {}
+    iteration = 0
+    roots = {}
+
+    try:
+        while True:
+            if iteration % TOP_RESCAN_EVERY == 0:
+                roots = collect_host_processes()
+
+            iteration += 1
+            now = time.time()
+            rows = []
+
+            for host, pids in list(roots.items()):
+                sample = sample_host(pids['servers'] + pids['celery'], cache)
+                if not sample['processes']:
+                    roots.pop(host)
+                    continue
+
+                # runserver logs every request, and an open connection means one is in flight
+                activity = max(last_log_activity(host), last_activity.get(host, started))
+                if sample['connections']:
+                    activity = now
+
+                last_activity[host] = activity
+                rows.append({'host': host, 'idle': now - activity, 'celery': len(pids['celery']), **sample})
+
+            if args.idle_stop:
+                for row in rows:
+                    if row['idle'] > args.idle_stop * 60:
+                        pprint('Stopping {}, idle for {:.0f} minutes'.format(row['host'], row['idle'] / 60), Mode.WARNING)
+                        stop_host_processes(roots[row['host']]['servers'] + roots[row['host']]['celery'], cache)
+                        roots.pop(row['host'])
+
+            rows.sort(key=lambda row: row[args.top_sort], reverse=args.top_sort != 'host')
+
+            print('\033[H\033[2J', end='')
+            pprint('{: <36} {: >7} {: >10} {: >6} {: >8} {: >6} {: >7} {: >8}'.format('HOST', 'CPU%', 'RSS MB', 'FDS', 'THREADS', 'PROCS', 'CELERY', 'IDLE'), Mode.OPERATION)
+            for row in rows:
+                pprint('{: <36} {: >7.1f} {: >10.1f} {: >6} {: >8} {: >6} {: >7} {: >7.0f}s'.format(
+                    row['host'], row['cpu'], row['rss'] / 1024 / 1024, row['fds'], row['threads'], row['processes'], row['celery'], row['idle'],
+                ), continuous=True)
+
+            time.sleep(args.top_interval)
+
+    except KeyboardInterrupt:
+        pass
+
+
+async def read_http_response(reader, status_line=None):
+    if status_line is None:
+        status_line = await reader.readline()
+
+    if not status_line:
+        raise ConnectionError('Connection closed by the server')
+
+    version, status = status_line.split()[:2]
+    status = int(status)
+    headers = {}
+
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    # HTTP/1.0 closes after each response unless keep-alive is announced
+    connection = headers.get('connection', '').lower()
+    reusable = connection == 'keep-alive' if version == b'HTTP/1.0' else connection != 'close'
+
+    # Interim responses (103 Early Hints, ...) are followed by the real one
+    if 100 <= status < 200 and status != 101:
+        return await read_http_response(reader)
+
+    if status < 200 or status in (204, 304):
+        return status, reusable
+
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if not size:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+
+                break
+
+            await reader.readexactly(size + 2)
+
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+
+    else:
+        await reader.read()
+        reusable = False
+
+    return status, reusable
+
+
+async def bench_worker(ip, port, host, path, ssl_context, keep_alive, deadline, result):
+    import asyncio
+
+    request = 'GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: django-run-bench\r\nConnection: {}\r\n\r\n'.format(
+        path, host, 'keep-alive' if keep_alive else 'close',
+    ).encode('latin-1')
+    reader = writer = None
+
+    async def send():
+        nonlocal reader, writer
+
+        if writer is not None:
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+
+            except ConnectionError:
+                status_line = b''
+
+            if status_line:
+                return await read_http_response(reader, status_line)
+
+            # The server dropped the idle kept-alive connection before answering, reconnect instead of counting an error
+            writer.close()
+            writer = None
+
+        reader, writer = await asyncio.open_connection(ip, port, ssl=ssl_context, server_hostname=host if ssl_context else None)
+        writer.write(request)
+        await writer.drain()
+        return await read_http_response(reader)
+
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+
+        try:
+            status, reusable = await asyncio.wait_for(send(), min(BENCH_REQUEST_TIMEOUT, deadline - time.monotonic()))
+
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError, asyncio.TimeoutError) as error:
+            if isinstance(error, asyncio.TimeoutError) and time.monotonic() >= deadline:
+                # Still in flight when the run ended, neither a sample nor an error
+                result['unfinished'] += 1
+
+            else:
+                name = 'TimeoutError' if isinstance(error, asyncio.TimeoutError) else error.__class__.__name__
+                result['errors'][name] = result['errors'].get(name, 0) + 1
+
+            if writer is not None:
+                writer.close()
+                writer = None
+
+            await asyncio.sleep(BENCH_ERROR_BACKOFF)
+            continue
+
+        result['latencies'].append(time.perf_counter() - start)
+        result['statuses'][status] = result['statuses'].get(status, 0) + 1
+
+        if not (keep_alive and reusable):
+            writer.close()
+            writer = None
+
+    if writer is not None:
+        writer.close()
+
+
+async def run_bench(ip, port, host, path='/', ssl_context=None, concurrency=BENCH_CONCURRENCY, duration=BENCH_DURATION, keep_alive=True):
+    import asyncio
+
+    result = {'latencies': [], 'errors': {}, 'statuses': {}, 'unfinished': 0}
+    start = time.monotonic()
+
+    await asyncio.gather(*(
+        bench_worker(ip, port, host, path, ssl_context, keep_alive, start + duration, result) for _ in range(concurrency)
+    ))
+
+    result['elapsed'] = time.monotonic() - start
+    return result
+
+
+def show_bench(name, result):
+    latencies = result['latencies']
+
+    if not latencies:
+        pprint('{: <8} no successful request, errors: {}'.format(name, result['errors']), Mode.FAIL)
+        return
+
+    pprint('{: <8} {: >9.1f} req/s  p50 {: >8.2f}ms  p95 {: >8.2f}ms  p99 {: >8.2f}ms  max {: >8.2f}ms'.format(
+        name, len(latencies) / result['elapsed'],
+        percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000, max(latencies) * 1000,
+    ), continuous=True)
+
+    statuses = ', '.join('{}: {}'.format(status, count) for status, count in sorted(result['statuses'].items()))
+    errors = ', '.join('{}: {}'.format(error, count) for error, count in sorted(result['errors'].items()))
+    pprint('{: <8} {} requests ({}){}{}'.format(
+        '', len(latencies), statuses, ', errors: {}'.format(errors) if errors else '',
+        ', {} unfinished at the end'.format(result['unfinished']) if result['unfinished'] else '',
+    ), continuous=True)
+
+
+def command_bench():
+    import asyncio
+
+    hosts = get_managed_host()
+    host = args.bench if args.bench in hosts else SERVER_NAME_FORMAT.format(args.bench)
+
+    if host not in hosts:
+        pprint('{} is not a managed host'.format(args.bench), Mode.FAIL)
+        sys.exit(1)
+
+    targets = []
+    if args.bench_target in ('both', 'direct'):
+        targets.append(('direct', hosts[host], int(BASE_PORT), None))
+
+    if args.bench_target in ('both', 'proxy'):
+        if args.use_nginx:
+            targets.append(('proxy', host, 80, None))
+
+        else:
+            targets.append(('proxy', host, 443, unverified_ssl_context()))
+
+    pprint('Benchmarking {}{} with {} connections for {:g}s each{}'.format(
+        host, args.bench_path, args.bench_concurrency, args.bench_duration, ', without keep-alive' if args.bench_no_keep_alive else '',
+    ), Mode.OPERATION)
+
+    results = {}
+    try:
+        for name, ip, port, ssl_context in targets:
+            results[name] = asyncio.run(run_bench(
+                ip, port, host, args.bench_path, ssl_context, args.bench_concurrency, args.bench_duration, not args.bench_no_keep_alive,
+            ))
+            show_bench(name, results[name])
+
+    except KeyboardInterrupt:
+        return
+
+    if all(results.get(name, {}).get('latencies') for name in ('direct', 'proxy')):
+        direct, proxy = results['direct']['latencies'], results['proxy']['latencies']
+        pprint('Proxy overhead: p50 {:+.2f}ms, p99 {:+.2f}ms'.format(
+            (percentile(proxy, 50) - percentile(direct, 50)) * 1000, (percentile(proxy, 99) - percentile(direct, 99)) * 1000,
+        ), Mode.INFO)
+
+
+def command_clear():
+    if not args.confirm_clear:
+        pprint("It's gonna erase ALL managed host, and ALL managed nginx config, use --confirm-clear to to so", Mode.WARNING)
+
+    else:
+        clear_all()
+
+
+def command_managed():
+    if args.json:
+        print(json.dumps(get_status(), indent=2))
+        return
+
+    show_managed(get_managed_host(), build_process_index()['by_bind'], get_celery_processes())
+
+
+def command_config():
+    if args.json:
+        print(json.dumps({'backend': get_proxy_backend().name, 'config': create_proxy_config(get_managed_host())}, indent=2))
+        return
+
+    pprint('Normal {} config file:'.format(get_proxy_backend().name), Mode.OPERATION)
+
+    normal_proxy_config = create_proxy_config(get_managed_host())
+
+    pprint(normal_proxy_config, Mode.NORMAL, continuous=True)
+
+
+def command_open_all():
+    import sh
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    by_bind = build_process_index()['by_bind']
+    running = {host: ip for host, ip in get_managed_host().items() if '{}:{}'.format(ip, BASE_PORT) in by_bind}
+
+    if not running:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(running)) as executor:
+        futures = {executor.submit(wait_until_ready, ip, host): host for host, ip in running.items()}
+
+        for future in as_completed(futures):
+            host = futures[future]
+
+            if future.result() is not None:
+                pprint('Opening [{}] endpoint in firefox [IP={}]'.format(host, running[host]))
+                sh.firefox(proxy_url(host))
+
+
+def command_erase():
+    active_hosts = erase_hosts(get_edited_hosts(), args.erase)
+
+    with privileged_batch():
+        update_managed_host(active_hosts)
+        update_proxy_config(active_hosts)
+
+
+def command_reload_config():
+    active_hosts = get_edited_hosts()
+
+    with privileged_batch():
+        update_managed_host(active_hosts)
+        update_proxy_config(active_hosts, force=True)
+
+
+class DnsResolver:
+
+    def __init__(self, extension):
+        self.extension = extension.strip('.').lower()
+        self.data_version = None
+        self.names = {}
+        self.wildcards = {}
+
+    def refresh(self):
+        # data_version only moves when another connection commits, so most queries skip the reload
+        version = state_db().execute('PRAGMA data_version').fetchone()[0]
+        if version == self.data_version:
+            return
+
+        self.data_version = version
+        self.names, self.wildcards = {}, {}
+
+        for name, ip, options in state_db().execute('SELECT name, ip, options FROM hosts WHERE ip IS NOT NULL'):
+            self.names[name.lower()] = ip
+            if json.loads(options).get('wildcard'):
+                self.wildcards[name.lower()] = ip
+
+    def resolve(self, name):
+        self.refresh()
+
+        if name in self.names:
+            return self.names[name]
+
+        # One label only, like Caddy's *.HOST site address and the *.HOST certificate name
+        _, _, parent = name.partition('.')
+        return self.wildcards.get(parent)
+
+    def answer(self, query):
+        try:
+            identifier, flags, questions = struct.unpack_from('!HHH', query)
+            if questions != 1 or flags & 0x8000:
+                return None
+
+            labels, offset = [], 12
+            while query[offset]:
+                labels.append(query[offset + 1:offset + 1 + query[offset]].decode('ascii').lower())
+                offset += 1 + query[offset]
+
+            qtype, qclass = struct.unpack_from('!HH', query, offset + 1)
+            question = query[12:offset + 5]
+
+        except (struct.error, IndexError, UnicodeDecodeError):
+            return None
+
+        name = '.'.join(labels)
+        ip = self.resolve(name)
+        answers = b''
+
+        if ip is None:
+            # NXDOMAIN inside our extension, REFUSED for names we are not responsible for
+            rcode = 3 if name == self.extension or name.endswith('.' + self.extension) else 5
+
+        else:
+            rcode = 0
+            if qtype in (1, 255) and qclass == 1:
+                answers = struct.pack('!HHHIH', 0xC00C, 1, 1, DNS_TTL, 4) + socket.inet_aton(ip)
+
+        # Response, authoritative, opcode and recursion desired copied from the query
+        flags = 0x8000 | 0x0400 | (flags & 0x7900) | rcode
+        return struct.pack('!HHHHHH', identifier, flags, 1, 1 if answers else 0, 0, 0) + question + answers
+
+
+def handle_dns_request(request, client_address, server):
+    query, sock = request
+    response = server.resolver.answer(query)
+
+    if response:
+        sock.sendto(response, client_address)
+
+
+def command_dns():
+    import socketserver
+
+    server = socketserver.UDPServer((args.dns_bind, args.dns_port), handle_dns_request)
+    server.resolver = DnsResolver(args.extension)
+    register_process('dns', os.getpid(), kind='dns', ip='{}:{}'.format(args.dns_bind, args.dns_port))
+
+    pprint('Answering managed hosts and *.{} on {}:{}'.format(args.extension, args.dns_bind, args.dns_port), Mode.OPERATION)
+    pprint(DNS_RESOLVER_HINT.format(extension=args.extension, bind=args.dns_bind, port=args.dns_port), Mode.INFO)
+
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        server.server_close()
+        unregister_process('dns', os.getpid())
+
+
+def command_hosts_file():
+    set_setting('hosts_file', args.hosts_file == 'on')
+
+    if args.hosts_file == 'off':
+        pprint('Managed hosts are left out of /etc/hosts, resolve them with --dns', Mode.WARNING)
+        pprint(DNS_RESOLVER_HINT.format(extension=args.extension, bind=args.dns_bind, port=args.dns_port), Mode.WARNING)
+
+    render_etc_hosts()
+
+
+def command_caddy_tls():
+    set_setting('caddy_tls', args.caddy_tls == 'on')
+
+    if args.caddy_tls == 'on':
+        pprint('Caddy must be able to read the keys of {}, e.g. chgrp caddy KEY && chmod 0640 KEY'.format(CERT_KEY_DEFAULT_PATH), Mode.WARNING)
+
+    update_proxy_config(get_managed_host())
+
+
+def command_import_hosts():
+    if not get_setting('hosts_file', True):
+        pprint('Managed hosts are not written to /etc/hosts (--hosts-file off), nothing to import', Mode.FAIL)
+        sys.exit(1)
+
+    with state_transaction() as db:
+        managed = import_etc_hosts(db)
+
+    pprint('Imported {} managed hosts from /etc/hosts'.format(len(managed)), Mode.OK)
+
+
+def strip_name_options(argv):
+    stripped = []
+    skip = False
+
+    for argument in argv:
+        if skip:
+            skip = False
+
+        elif argument in ('--name', '--raw-name'):
+            skip = True
+
+        elif not argument.startswith(('--name=', '--raw-name=')):
+            stripped.append(argument)
+
+    return stripped
+
+
+def command_relaunch():
+    record = get_host_record(args.relaunch)
+
+    if not record or not record['project_path']:
+        pprint('No launch remembered for {}'.format(args.relaunch), Mode.FAIL)
+        sys.exit(1)
+
+    script = os.path.abspath(__file__)
+    options = record['options']
+    environ = dict(os.environ)
+
+    # Put the remembered interpreter first so the same env is detected and used for runserver
+    if options.get('python'):
+        environ['PATH'] = os.pathsep.join([os.path.dirname(options['python']), environ.get('PATH', '')])
+
+    pprint('Relaunching {} from {}'.format(args.relaunch, record['project_path']), Mode.OPERATION)
+    os.chdir(record['project_path'])
+    # The relaunch is recorded again, so an older name option would pile up on each one
+    os.execve(sys.executable, [sys.executable, script, *strip_name_options(options.get('argv', [])), '--raw-name', args.relaunch], environ)
+
+
+COMMANDS = [
+    ('daemon', command_daemon),
+    ('startup_bench', command_startup_bench),
+    ('stats', command_stats),
+    ('stack', command_stack),
+    ('relaunch', command_relaunch),
+    ('dns', command_dns),
+    ('hosts_file', command_hosts_file),
+    ('caddy_tls', command_caddy_tls),
+    ('import_hosts', command_import_hosts),
+    ('certs', command_certs),
+    ('generate_certs', command_generate_certs),
+    ('logs', command_logs),
+    ('top', command_top),
+    ('bench', command_bench),
+    ('clear', command_clear),
+    ('managed', command_managed),
+    ('config', command_config),
+    ('open_all', command_open_all),
+    ('erase', command_erase),
+    ('reload_config', command_reload_config),
+]
+
+
+def main():
+    if not args.daemon and not args.no_daemon and run_daemon_client():
+        return
+
+    for flag, command in COMMANDS:
+        if getattr(args, flag):
+            return command()
+
+    command_run()
+
+
+def command_run():
+
+    skip_creation = False
+
+    choosen_ip = ''
+
+    active_hosts = get_edited_hosts()
+
+    with timed_phase('resolve_name'):
+        if args.use_tmux_window_name:
+            active_tmux_windows = get_tmux_windows_name()
+
+        else:
+            active_tmux_windows = get_project_name()
+
+    if args.with_debug:
+        pass
+        # If we want the installer, we need to have it.
+        # This need to be done in the target venv, not in the django-run venv, aborting for now
+        # pprint("Searching for debugpy packages", Mode.INFO)
+        # for module in pkgutil.iter_modules():
+        #     if module.name == "debugpy":
+        #         pprint("Debugger debugpy found", Mode.INFO)
+        #         break
+        #
+        # else:
+        #     pprint("Debugger debugpy not found, installing", Mode.WARNING)
+        #     pip.main(["install", "debugpy"])
+
+    if args.see_tmux_name:
+        pprint("Tmux window's name: {}, server host: {}".format(active_tmux_windows, SERVER_NAME_FORMAT.format(active_tmux_windows)), Mode.INFO)
+
+    with timed_phase('resolve_name'):
+        which_python = shutil.which("python") or ''
+        rmatch = re.match(".*\/miniconda3\/envs\/(?P<env>.*)\/bin\/python", which_python)
+
+        if rmatch:
+            env = rmatch.groupdict().get("env")
+
+            if args.prefix_name:
+                env = f"{args.prefix_name}.{env}"
+
+            if args.suffix_name:
+                env = f"{env}.{args.suffix_name}"
+
+            server_endpoint = SERVER_NAME_FORMAT.format(env)
+
+        else:
+            server_endpoint = SERVER_NAME_FORMAT.format(active_tmux_windows)
+
+        if args.name:
+            server_endpoint = SERVER_NAME_FORMAT.format(args.name)
+
+        if args.raw_name:
+            server_endpoint = args.raw_name
+
+    with timed_phase('find_managepy'):
+        location_managepy = get_managepy_file()
+
+    if not location_managepy:
+        pprint('No manage.py file found !', Mode.FAIL)
+        skip_creation = True
+
+    else:
+        pprint('Manage.py file found: {}'.format(location_managepy))
+
+    more_args = ()
+    if args.use_ssl:
+        certificate = get_certificate(server_endpoint)
+
+        if not certificate:
+            pprint('No certificate for {} in {}, use --generate-certs'.format(server_endpoint, CERT_KEY_DEFAULT_PATH), Mode.FAIL)
+            sys.exit(1)
+
+        pprint('Using certificate {}'.format(certificate[0]), Mode.INFO)
+        more_args = ("--cert-file", certificate[0], "--key-file", certificate[1])
+
+    commands = [PreRunStep(command, command) for command in args.pre_run]
+    commands.extend(PreRunStep(command, command, required=False) for command in args.pre_run_background)
+    if args.sls:
+        commands.append(PreRunStep("generate_sls", f"python {location_managepy} generate_sls tmp_states -yy"))
+        commands.append(PreRunStep("generate_extra_sls", f"python {location_managepy} generate_extra_sls tmp_states_extra -yy"))
+
+    # Launch options are only remembered when a server is really started with them
+    starting = bool(location_managepy) and not (server_endpoint in active_hosts and is_django_active(active_hosts[server_endpoint]))
+    proxy_changed = False
+    fingerprint = None
+
+    if starting:
+        options = {name: value for name, value in [('workers', args.workers), ('wildcard', args.wildcard)] if value is not None}
+        if options:
+            proxy_changed = save_host_options(server_endpoint, **options)
+
+        # One walk of the project tree, shared by the static paths and the pre-run cache
+        static_proxy = args.static_proxy if args.static_proxy is not None else host_options(server_endpoint).get('static_proxy')
+        if commands or static_proxy:
+            fingerprint = project_fingerprint(os.path.dirname(os.path.abspath(location_managepy)))
+
+        with timed_phase('static_paths'):
+            proxy_changed = refresh_static_paths(server_endpoint, location_managepy, fingerprint=fingerprint) or proxy_changed
+
+        record_launch(server_endpoint, os.getcwd(), sys.argv[1:], which_python)
+
+    if server_endpoint in active_hosts:
+        skip_creation = True
+
+        pprint('Host already in config for this name!', Mode.FAIL)
+        pprint('Ip for {} is {}'.format(server_endpoint, active_hosts[server_endpoint]), Mode.INFO)
+
+        choosen_ip = active_hosts[server_endpoint]
+
+        if proxy_changed:
+            pprint('Worker count or static paths changed, updating the proxy config')
+
+        # The store is committed before the helper runs, so every launch re-applies it in case a helper run failed
+        with timed_phase('write_config'), privileged_batch():
+            render_etc_hosts()
+            update_proxy_config(active_hosts)
+
+    response = None
+    if not skip_creation and not args.no_daemon:
+        response = daemon_request('allocate', host=server_endpoint)
+
+    if response is not None:
+        choosen_ip = response['ip']
+        active_hosts[server_endpoint] = choosen_ip
+        pprint('Daemon allocated {} @ {}'.format(server_endpoint, choosen_ip))
+
+    elif not skip_creation:
+        with timed_phase('allocate_ip'):
+            choosen_ip = search_free_dev_ip(server_endpoint)
+
+        if not choosen_ip:
+            sys.exit(1)
+
+        pprint('Creating /etc/hosts config for {} @ {}'.format(server_endpoint, choosen_ip))
+
+        # Pick up hosts added by concurrent launches since the start of this run
+        active_hosts = get_managed_host()
+        active_hosts[server_endpoint] = choosen_ip
+        with timed_phase('write_config'), privileged_batch():
+            update_managed_host(active_hosts)
+
+            pprint('Creating Nginx config for {} @ {}'.format(server_endpoint, choosen_ip))
+            update_proxy_config(active_hosts)
+
+    is_active = bool(choosen_ip) and is_django_active(choosen_ip)
+
+    if not args.no_open and is_active:
+        pprint('Opening the endpoint in firefox, since \'--no-open\' is not passed', Mode.OPERATION)
+
+        FirefoxAsyncLaunch(server_endpoint, choosen_ip).start()
+
+    if not is_active and location_managepy:
+        if not args.no_open:
+            pprint('Opening the endpoint in firefox once ready, since \'--no-open\' is not passed', Mode.OPERATION)
+
+        pprint('Running django server {} @ {}'.format(server_endpoint, choosen_ip))
+
+        celery_pool = None
+        if args.celery:
+            celery_pool = CeleryPool(
+                server_endpoint,
+                workers=args.celery_workers,
+                concurrency=args.celery_concurrency,
+                pool=args.celery_pool,
+                app=args.celery_app,
+                beat=not args.no_celery_beat,
+            )
+            celery_pool.start()
+
+        def on_spawn(processes):
+            FirefoxAsyncLaunch(server_endpoint, choosen_ip, open_browser=not args.no_open, record=True).start()
+
+        try:
+            if args.lazy:
+                # Probing would start the server right away, so only open the browser when asked to
+                if not args.no_open:
+                    FirefoxAsyncLaunch(server_endpoint, choosen_ip, record=True).start()
+
+                lazy_server_activate(location_managepy, active_hosts[server_endpoint], commands, args=more_args, log_name=server_endpoint, idle_timeout=args.idle_timeout, fingerprint=fingerprint)
+
+            else:
+                django_server_activate(location_managepy, active_hosts[server_endpoint], commands, args=more_args, kwargs=args, on_spawn=on_spawn, ports=worker_ports(server_endpoint), log_name=server_endpoint, fingerprint=fingerprint)
+
+        finally:
+            if celery_pool:
+                celery_pool.stop()
+
+    elif not location_managepy:
+        pprint('Exiting ...', Mode.FAIL)
+
+    else:
+        pprint('Django server already running!')
+
 
+if __name__ == '__main__':
+    args, uargs = parser.parse_known_args()
+    SERVER_NAME_FORMAT = f"{{}}.{args.extension}"
 
-main()
+    main()
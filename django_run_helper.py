@@ -0,0 +1,316 @@
+import os
+import re
+import sys
+import json
+import pwd
+import ipaddress
+import fcntl
+import subprocess
+from tempfile import NamedTemporaryFile
+
+
+ANCHOR_START = """### START AUTO MANAGE ###"""
+ANCHOR_STOP = """### STOP AUTO MANAGE ###"""
+
+HOSTS_FILE = '/etc/hosts'
+LOCK_FILE = '/etc/.django-run.lock'
+
+# Everything the helper may touch is fixed here, whatever the caller sends
+CADDY_CONFIG_FILE = '/etc/caddy/Caddyfile'
+CADDY_FRAGMENT_DIR = '/etc/caddy/django-run'
+CADDY_ADMIN = 'http://localhost:2019'
+NGINX_CONFIG_FILE = '/etc/nginx/sites-available/managed'
+NGINX_FRAGMENT_DIR = '/etc/nginx/django-run'
+
+CONFIG_FILES = [CADDY_CONFIG_FILE, NGINX_CONFIG_FILE]
+FRAGMENT_DIRS = [CADDY_FRAGMENT_DIR, NGINX_FRAGMENT_DIR]
+OWNERS = [None, 'caddy']
+BACKENDS = ['caddy', 'nginx']
+HOST_NAME = re.compile(r'^[A-Za-z0-9_-]+(\.[A-Za-z0-9_-]+)*$')
+
+
+def parse_managed_block(content):
+    before, managed, after = [], {}, []
+    target = before
+
+    for line in content.split('\n'):
+
+        if line == ANCHOR_START and target is before:
+            target = managed
+            continue
+
+        if line == ANCHOR_STOP and target is managed:
+            target = after
+            continue
+
+        if target is managed:
+            try:
+                ip, name = line.split()
+                managed[name] = ip
+            except ValueError:
+                pass
+
+        else:
+            target.append(line)
+
+    return before, managed, after
+
+
+def render_hosts(before, managed, after):
+    # No block yet: append it, keeping the trailing newline at the end of the file
+    if not after:
+        while before and before[-1] == '':
+            before = before[:-1]
+        after = ['']
+
+    middle = ['{}\t{}'.format(ip, name) for name, ip in managed.items()]
+    return '\n'.join([*before, ANCHOR_START, *middle, ANCHOR_STOP, *after])
+
+
+def atomic_write(path, content, owner=None):
+    stat = os.stat(path) if os.path.exists(path) else None
+
+    with NamedTemporaryFile('w', dir=os.path.dirname(path), prefix='.django-run-', delete=False) as temp:
+        temp.write(content)
+        temp.flush()
+        os.fsync(temp.fileno())
+
+    if stat:
+        os.chmod(temp.name, stat.st_mode & 0o7777)
+        os.chown(temp.name, stat.st_uid, stat.st_gid)
+
+    else:
+        os.chmod(temp.name, 0o644)
+
+    if owner:
+        user = pwd.getpwnam(owner)
+        os.chown(temp.name, user.pw_uid, user.pw_gid)
+
+    os.replace(temp.name, path)
+
+
+def apply_hosts(change):
+    with open(HOSTS_FILE, 'r') as etc:
+        content = etc.read()
+
+    before, managed, after = parse_managed_block(content)
+    updated = dict(managed)
+
+    for name in change.get('removed', []):
+        updated.pop(name, None)
+
+    updated.update(change.get('added', {}))
+
+    if updated == managed and ANCHOR_START in content:
+        return False
+
+    atomic_write(HOSTS_FILE, render_hosts(before, updated, after))
+    return True
+
+
+def apply_files(files):
+    changed = []
+
+    for file in files:
+        if os.path.exists(file['path']):
+            with open(file['path'], 'r') as current:
+                if current.read() == file['content']:
+                    continue
+
+        os.makedirs(os.path.dirname(file['path']), exist_ok=True)
+        atomic_write(file['path'], file['content'], file.get('owner'))
+        changed.append(file['path'])
+
+    return changed
+
+
+def remove_files(paths):
+    removed = []
+
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+            removed.append(path)
+
+    return removed
+
+
+def snapshot_files(paths):
+    saved = {}
+
+    for path in paths:
+        try:
+            with open(path, 'r') as file:
+                stat = os.fstat(file.fileno())
+                saved[path] = (file.read(), stat.st_mode & 0o7777, stat.st_uid, stat.st_gid)
+
+        except FileNotFoundError:
+            saved[path] = None
+
+    return saved
+
+
+def restore_files(saved):
+    for path, state in saved.items():
+        if state is None:
+            if os.path.exists(path):
+                os.remove(path)
+
+            continue
+
+        content, mode, uid, gid = state
+        atomic_write(path, content)
+        os.chmod(path, mode)
+        os.chown(path, uid, gid)
+
+
+def is_allowed_path(path):
+    if path in CONFIG_FILES:
+        return True
+
+    name = os.path.basename(path)
+    return os.path.dirname(path) in FRAGMENT_DIRS and path == os.path.normpath(path) and not name.startswith('.')
+
+
+def check_change_set(change_set):
+    hosts = change_set.get('hosts', {})
+
+    for name, ip in hosts.get('added', {}).items():
+        ipaddress.ip_address(ip)
+        if not HOST_NAME.match(name):
+            raise ValueError('Invalid host name {!r}'.format(name))
+
+    for file in change_set.get('files', []):
+        if not is_allowed_path(file['path']):
+            raise ValueError('Refusing to write {}'.format(file['path']))
+
+        if file.get('owner') not in OWNERS:
+            raise ValueError('Refusing to give {} to {}'.format(file['path'], file['owner']))
+
+    for path in change_set.get('remove', []):
+        if not is_allowed_path(path):
+            raise ValueError('Refusing to remove {}'.format(path))
+
+    if 'reload' in change_set and change_set['reload'].get('backend') not in BACKENDS:
+        raise ValueError('Unknown proxy backend {!r}'.format(change_set['reload'].get('backend')))
+
+    if 'admin' in change_set.get('reload', {}) and not is_loopback_admin(change_set['reload']['admin']):
+        raise ValueError('Refusing to post the config to {}'.format(change_set['reload']['admin']))
+
+
+def is_loopback_admin(url):
+    from urllib.parse import urlsplit
+
+    # Root sends the whole Caddyfile there, so only a local admin endpoint is accepted
+    try:
+        parts = urlsplit(url)
+        parts.port
+        loopback = parts.hostname == 'localhost' or ipaddress.ip_address(parts.hostname or '').is_loopback
+
+    except ValueError:
+        return False
+
+    return loopback and parts.scheme in ('http', 'https') and parts.path in ('', '/') and not (parts.query or parts.fragment or parts.username)
+
+
+def validate_proxy(reload):
+    if reload['backend'] == 'nginx':
+        command = ['nginx', '-t', '-q']
+
+    else:
+        command = ['caddy', 'validate', '--adapter', 'caddyfile', '--config', CADDY_CONFIG_FILE]
+
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True)
+
+    except FileNotFoundError:
+        return None
+
+    return (completed.stderr or completed.stdout).strip() if completed.returncode else None
+
+
+def reload_proxy(reload):
+    import urllib.error
+    import urllib.request
+
+    if reload['backend'] == 'nginx':
+        completed = subprocess.run(['nginx', '-s', 'reload'], capture_output=True, text=True)
+        return completed.stderr.strip() if completed.returncode else None
+
+    with open(CADDY_CONFIG_FILE, 'r') as config:
+        content = config.read()
+
+    request = urllib.request.Request(
+        '{}/load'.format(reload.get('admin', CADDY_ADMIN).rstrip('/')),
+        data=content.encode('utf-8'),
+        headers={'Content-Type': 'text/caddyfile'},
+        method='POST',
+    )
+
+    try:
+        with urllib.request.urlopen(request, timeout=10):
+            return None
+
+    except urllib.error.HTTPError as error:
+        raise ValueError('Caddy refused the config: {}'.format(error.read().decode('utf-8', 'replace').strip()))
+
+    except OSError:
+        completed = subprocess.run(['systemctl', 'reload', 'caddy'], capture_output=True, text=True)
+        return completed.stderr.strip() if completed.returncode else None
+
+
+def apply_change_set(change_set):
+    result = {}
+
+    if 'hosts' in change_set:
+        result['hosts'] = apply_hosts(change_set['hosts'])
+
+    if 'files' in change_set:
+        result['files'] = apply_files(change_set['files'])
+
+    if 'remove' in change_set:
+        result['remove'] = remove_files(change_set['remove'])
+
+    if 'reload' in change_set:
+        error = validate_proxy(change_set['reload'])
+        if error:
+            raise ValueError('Proxy config does not validate: {}'.format(error))
+
+        # A reload that fails after validation (proxy not running) keeps the new files
+        result['reload_error'] = reload_proxy(change_set['reload'])
+
+    return result
+
+
+def main():
+    change_set = json.load(sys.stdin)
+
+    try:
+        check_change_set(change_set)
+
+    except (ValueError, KeyError, TypeError, AttributeError) as error:
+        sys.stderr.write('Invalid change set: {}\n'.format(error))
+        sys.exit(1)
+
+    with open(LOCK_FILE, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        paths = [file['path'] for file in change_set.get('files', [])] + change_set.get('remove', [])
+        if 'hosts' in change_set:
+            paths.append(HOSTS_FILE)
+
+        saved = snapshot_files(paths)
+
+        try:
+            result = apply_change_set(change_set)
+
+        except Exception as error:
+            restore_files(saved)
+            sys.stderr.write('{}, rolled back {} file(s)\n'.format(error, len(saved)))
+            sys.exit(1)
+
+    json.dump(result, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django_run  # noqa: E402
+
+
+@pytest.fixture
+def cli(monkeypatch, tmp_path):
+    # args is only set when run as a script, and the state store lives under $HOME
+    def parse(*argv):
+        monkeypatch.setattr(django_run, 'args', django_run.parser.parse_known_args(list(argv))[0], raising=False)
+        return django_run.args
+
+    state_dir = tmp_path / 'state'
+    monkeypatch.setattr(django_run, 'STATE_DIR', str(state_dir))
+    monkeypatch.setattr(django_run, 'STATE_DB', str(state_dir / 'state.sqlite3'))
+    monkeypatch.setattr(django_run, '_state', django_run.threading.local())
+
+    parse()
+    return parse
@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import pytest
+
+import django_run
+
+RESPONSES = {
+    b'/': b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+    b'/empty': b'HTTP/1.1 204 No Content\r\n\r\n',
+    b'/hints': b'HTTP/1.1 103 Early Hints\r\nLink: </app.css>\r\n\r\nHTTP/1.1 304 Not Modified\r\nETag: "1"\r\n\r\n',
+    b'/chunked': b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n0\r\n\r\n',
+    b'/close': b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nbye',
+    b'/http10': b'HTTP/1.0 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+    b'/http10-keep-alive': b'HTTP/1.0 200 OK\r\nConnection: keep-alive\r\nContent-Length: 5\r\n\r\nhello',
+    b'/dropped': b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello',
+}
+# Closed by the server after one response, /dropped without announcing it
+CLOSING = [b'/close', b'/http10', b'/dropped']
+
+
+async def handle(reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+
+            path = request_line.split()[1]
+            if path == b'/hang':
+                await asyncio.sleep(60)
+
+            writer.write(RESPONSES[path])
+            await writer.drain()
+
+            if path in CLOSING:
+                break
+
+    finally:
+        writer.close()
+
+
+def bench(path, duration=0.3, **kwargs):
+    async def run():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        try:
+            return await django_run.run_bench('127.0.0.1', port, 'test.local', path, concurrency=2, duration=duration, **kwargs)
+
+        finally:
+            server.close()
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize('path, status', [
+    ('/', 200), ('/empty', 204), ('/hints', 304), ('/chunked', 200), ('/close', 200), ('/http10', 200), ('/http10-keep-alive', 200), ('/dropped', 200),
+])
+def test_bench_reads_every_response_kind(path, status):
+    result = bench(path)
+
+    assert result['errors'] == {}
+    assert list(result['statuses']) == [status]
+    assert len(result['latencies']) == result['statuses'][status] > 2
+
+
+def test_bench_without_keep_alive():
+    result = bench('/', keep_alive=False)
+
+    assert result['errors'] == {}
+    assert result['statuses'][200] > 2
+
+
+def test_bench_stops_at_deadline_when_server_hangs():
+    start = time.monotonic()
+    result = bench('/hang', duration=0.5)
+
+    assert time.monotonic() - start < 2
+    assert result['latencies'] == []
+    assert result['unfinished'] == 2
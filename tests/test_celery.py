@@ -0,0 +1,12 @@
+import django_run
+
+
+def test_missing_celery_does_not_stop_the_launch(cli, monkeypatch, tmp_path):
+    monkeypatch.setenv('PATH', str(tmp_path))
+    pool = django_run.CeleryPool('api.local', workers=2)
+
+    pool.start()
+    pool.stop()
+
+    assert pool.processes == {}
+    assert django_run.get_registered_process('beat:api.local') is None
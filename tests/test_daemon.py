@@ -0,0 +1,47 @@
+import socketserver
+import threading
+
+import pytest
+
+import django_run
+
+
+@pytest.fixture
+def daemon(cli, monkeypatch, tmp_path):
+    monkeypatch.setattr(django_run, 'render_etc_hosts', lambda: None)
+    monkeypatch.setattr(django_run, 'update_proxy_config', lambda hosts, force=False: None)
+    monkeypatch.setattr(django_run, 'DAEMON_SOCKET', str(tmp_path / 'daemon.sock'))
+    django_run.update_managed_host({'api.local': '127.0.0.2', 'web.local': '127.0.0.3'})
+
+    server = socketserver.ThreadingUnixStreamServer(django_run.DAEMON_SOCKET, django_run.handle_daemon_connection)
+    server.daemon = django_run.DjangoRunDaemon()
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_remove_shows_the_removed_hosts_on_the_client(cli, daemon, capsys):
+    cli('--remove', 'api', '--reload-config')
+
+    assert django_run.run_daemon_client()
+    assert 'Removing api.local with ip 127.0.0.2' in capsys.readouterr().out
+    assert django_run.get_managed_host() == {'web.local': '127.0.0.3'}
+
+
+def test_erase_shows_the_erased_hosts_on_the_client(cli, daemon, capsys):
+    cli('--erase', 'web.local')
+
+    assert django_run.run_daemon_client()
+    assert 'Removing web.local from /etc/hosts' in capsys.readouterr().out
+    assert django_run.get_managed_host() == {'api.local': '127.0.0.2'}
+
+
+def test_other_options_are_refused(daemon):
+    request = {'command': 'remove', 'params': {'patterns': ['api']}, 'options': {**django_run.daemon_options(), 'extension': 'test'}}
+
+    assert daemon.daemon.handle(request) == {'mismatch': django_run.daemon_options()}
+    assert daemon.daemon.handle({'command': 'ping'})['pid']
@@ -0,0 +1,93 @@
+import socket
+import socketserver
+import struct
+import threading
+
+import pytest
+
+import django_run
+
+
+def build_query(name, qtype=1, identifier=0x1234):
+    labels = b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.split('.'))
+    return struct.pack('!HHHHHH', identifier, 0x0100, 1, 0, 0, 0) + labels + b'\0' + struct.pack('!HH', qtype, 1)
+
+
+def parse_response(response):
+    identifier, flags, questions, answers = struct.unpack_from('!HHHH', response)
+    ip = socket.inet_ntoa(response[-4:]) if answers else None
+    return identifier, flags & 0xF, answers, ip
+
+
+@pytest.fixture
+def hosts(cli, monkeypatch):
+    monkeypatch.setattr(django_run, 'render_etc_hosts', lambda: None)
+
+    def add(name, ip, wildcard=False):
+        # From another thread, so the resolver's connection sees a commit from elsewhere like in --dns
+        def write():
+            django_run.save_host_options(name, wildcard=wildcard)
+            django_run.update_managed_host({**django_run.get_managed_host(), name: ip})
+
+        thread = threading.Thread(target=write)
+        thread.start()
+        thread.join()
+
+    add('api.local', '127.0.0.2', wildcard=True)
+    add('web.local', '127.0.0.3')
+    return add
+
+
+@pytest.mark.parametrize('name, rcode, ip', [
+    ('api.local', 0, '127.0.0.2'),
+    ('WEB.local', 0, '127.0.0.3'),
+    ('tenant.api.local', 0, '127.0.0.2'),
+    ('a.b.api.local', 3, None),
+    ('tenant.web.local', 3, None),
+    ('missing.local', 3, None),
+    ('example.com', 5, None),
+])
+def test_answer(hosts, name, rcode, ip):
+    identifier, answered_rcode, _, answered_ip = parse_response(django_run.DnsResolver('local').answer(build_query(name)))
+
+    assert identifier == 0x1234
+    assert answered_rcode == rcode
+    assert answered_ip == ip
+
+
+def test_answer_other_record_types_are_empty(hosts):
+    _, rcode, answers, _ = parse_response(django_run.DnsResolver('local').answer(build_query('api.local', qtype=28)))
+
+    assert rcode == 0
+    assert answers == 0
+
+
+@pytest.mark.parametrize('query', [b'', b'\x12\x34', build_query('api.local')[:14], struct.pack('!HHH', 1, 0x8000, 1) + b'\0' * 10])
+def test_answer_ignores_malformed_queries(hosts, query):
+    assert django_run.DnsResolver('local').answer(query) is None
+
+
+def test_resolver_sees_new_hosts(hosts):
+    resolver = django_run.DnsResolver('local')
+    assert parse_response(resolver.answer(build_query('new.local')))[1] == 3
+
+    hosts('new.local', '127.0.0.4')
+    assert parse_response(resolver.answer(build_query('new.local')))[3] == '127.0.0.4'
+
+
+def test_udp_query(hosts):
+    server = socketserver.UDPServer(('127.0.0.1', 0), django_run.handle_dns_request)
+    server.resolver = django_run.DnsResolver('local')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+            client.settimeout(5)
+            client.sendto(build_query('tenant.api.local', identifier=7), server.server_address)
+            response, _ = client.recvfrom(512)
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert parse_response(response) == (7, 0, 1, '127.0.0.2')
@@ -0,0 +1,62 @@
+import pytest
+
+from django_run_helper import check_change_set, is_allowed_path, is_loopback_admin
+
+
+@pytest.mark.parametrize('path, allowed', [
+    ('/etc/caddy/Caddyfile', True),
+    ('/etc/nginx/sites-available/managed', True),
+    ('/etc/caddy/django-run/api.local.caddy', True),
+    ('/etc/nginx/django-run/api.local.conf', True),
+    ('/etc/hosts', False),
+    ('/etc/caddy/django-run', False),
+    ('/etc/caddy/django-run/.hidden', False),
+    ('/etc/caddy/django-run/../../sudoers', False),
+    ('/etc/caddy/django-run/sub/api.caddy', False),
+    ('etc/caddy/Caddyfile', False),
+])
+def test_is_allowed_path(path, allowed):
+    assert is_allowed_path(path) == allowed
+
+
+def test_check_change_set_accepts_what_the_client_sends():
+    check_change_set({
+        'hosts': {'added': {'api.local': '127.0.0.2'}, 'removed': ['web.local']},
+        'files': [
+            {'path': '/etc/caddy/Caddyfile', 'content': 'import /etc/caddy/django-run/*.caddy\n', 'owner': 'caddy'},
+            {'path': '/etc/caddy/django-run/api.local.caddy', 'content': ''},
+        ],
+        'remove': ['/etc/caddy/django-run/web.local.caddy'],
+        'reload': {'backend': 'caddy', 'admin': 'http://localhost:2019'},
+    })
+
+
+@pytest.mark.parametrize('change_set', [
+    {'hosts': {'added': {'api.local': 'localhost'}}},
+    {'hosts': {'added': {'api.local\n1.2.3.4 bank.com': '127.0.0.2'}}},
+    {'files': [{'path': '/etc/sudoers', 'content': ''}]},
+    {'files': [{'path': '/etc/caddy/django-run/api.caddy', 'content': '', 'owner': 'root2'}]},
+    {'remove': ['/etc/passwd']},
+    {'reload': {'backend': 'apache'}},
+    {'reload': {'backend': 'caddy', 'admin': 'http://example.com:2019'}},
+])
+def test_check_change_set_rejects(change_set):
+    with pytest.raises(ValueError):
+        check_change_set(change_set)
+
+
+@pytest.mark.parametrize('url, allowed', [
+    ('http://localhost:2019', True),
+    ('http://127.0.0.1:2019/', True),
+    ('http://[::1]:2019', True),
+    ('https://127.0.0.2:2019', True),
+    ('http://10.0.0.1:2019', False),
+    ('http://localhost.example.com:2019', False),
+    ('http://user@localhost:2019', False),
+    ('http://localhost:2019/config', False),
+    ('http://localhost:port', False),
+    ('file:///etc/caddy/Caddyfile', False),
+    ('localhost:2019', False),
+])
+def test_is_loopback_admin(url, allowed):
+    assert is_loopback_admin(url) == allowed
@@ -0,0 +1,66 @@
+from django_run_helper import ANCHOR_START, ANCHOR_STOP, parse_managed_block, render_hosts
+
+ETC_HOSTS = '\n'.join([
+    '127.0.0.1\tlocalhost',
+    '',
+    ANCHOR_START,
+    '127.0.0.2\tapi.local',
+    'not a host line',
+    '127.0.0.3\tweb.local',
+    ANCHOR_STOP,
+    '::1\tip6-localhost',
+    '',
+])
+
+
+def test_parse_managed_block():
+    before, managed, after = parse_managed_block(ETC_HOSTS)
+
+    assert before == ['127.0.0.1\tlocalhost', '']
+    assert managed == {'api.local': '127.0.0.2', 'web.local': '127.0.0.3'}
+    assert after == ['::1\tip6-localhost', '']
+
+
+def test_render_hosts_keeps_the_rest_of_the_file():
+    before, managed, after = parse_managed_block(ETC_HOSTS)
+    managed.pop('api.local')
+    managed['new.local'] = '127.0.0.4'
+
+    assert render_hosts(before, managed, after) == '\n'.join([
+        '127.0.0.1\tlocalhost',
+        '',
+        ANCHOR_START,
+        '127.0.0.3\tweb.local',
+        '127.0.0.4\tnew.local',
+        ANCHOR_STOP,
+        '::1\tip6-localhost',
+        '',
+    ])
+
+
+def test_render_hosts_round_trip():
+    content = render_hosts(*parse_managed_block(ETC_HOSTS))
+
+    assert parse_managed_block(content) == parse_managed_block(ETC_HOSTS)
+    assert render_hosts(*parse_managed_block(content)) == content
+
+
+def test_render_hosts_appends_a_missing_block():
+    before, managed, after = parse_managed_block('127.0.0.1\tlocalhost\n\n')
+
+    assert managed == {}
+    assert render_hosts(before, {'api.local': '127.0.0.2'}, after) == '\n'.join([
+        '127.0.0.1\tlocalhost',
+        ANCHOR_START,
+        '127.0.0.2\tapi.local',
+        ANCHOR_STOP,
+        '',
+    ])
+
+
+def test_stray_stop_anchor_is_kept_as_is():
+    before, managed, after = parse_managed_block('\n'.join([ANCHOR_STOP, '127.0.0.1\tlocalhost', '']))
+
+    assert before == [ANCHOR_STOP, '127.0.0.1\tlocalhost', '']
+    assert managed == {}
+    assert after == []
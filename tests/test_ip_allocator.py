@@ -0,0 +1,50 @@
+import pytest
+
+import django_run
+
+
+@pytest.mark.parametrize('ip_range, expected', [
+    ('127.0.0.5', ['127.0.0.5']),
+    ('127.0.0.2-4', ['127.0.0.2', '127.0.0.3', '127.0.0.4']),
+    ('127.0.0.254 - 127.0.1.1', ['127.0.0.254', '127.0.0.255', '127.0.1.0', '127.0.1.1']),
+    ('127.0.1.0/30', ['127.0.1.1', '127.0.1.2']),
+])
+def test_parse_ip_range(ip_range, expected):
+    assert django_run.parse_ip_range(ip_range) == expected
+
+
+def test_allocator_merges_ranges_in_order():
+    allocator = django_run.IpAllocator(['127.0.0.3-4', '127.0.0.2-3'])
+
+    assert allocator.pool == ['127.0.0.3', '127.0.0.4', '127.0.0.2']
+
+
+def test_allocator_skips_used_and_unbindable_ips(monkeypatch):
+    monkeypatch.setattr(django_run, 'is_bindable', lambda ip, port: ip != '127.0.0.3')
+    allocator = django_run.IpAllocator(['127.0.0.2-5'])
+    allocator.mark_used('127.0.0.2')
+    allocator.mark_used('10.0.0.1')
+
+    assert allocator.allocate('8000') == '127.0.0.4'
+    assert allocator.allocate('8000') == '127.0.0.5'
+    assert allocator.allocate('8000') == ''
+
+
+def test_search_free_dev_ip_reserves_the_ip(cli, monkeypatch):
+    cli('--ip-range', '127.0.0.2-3')
+    monkeypatch.setattr(django_run, 'is_bindable', lambda ip, port: True)
+
+    assert django_run.search_free_dev_ip('api.local') == '127.0.0.2'
+    # Not in hosts yet, but reserved for the launch that is still writing its config
+    assert django_run.search_free_dev_ip('web.local') == '127.0.0.3'
+    assert django_run.search_free_dev_ip('other.local') == ''
+
+
+def test_search_free_dev_ip_reuses_expired_reservations(cli, monkeypatch):
+    cli('--ip-range', '127.0.0.2')
+    monkeypatch.setattr(django_run, 'is_bindable', lambda ip, port: True)
+
+    assert django_run.search_free_dev_ip('api.local') == '127.0.0.2'
+    django_run.state_db().execute('UPDATE reservations SET expires = 0')
+
+    assert django_run.search_free_dev_ip('web.local') == '127.0.0.2'
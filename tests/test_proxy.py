@@ -0,0 +1,101 @@
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import django_run
+import django_run_helper
+
+
+@pytest.fixture
+def caddy_admin():
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        status = 200
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            requests.append((self.path, self.headers['Content-Type'], body.decode('utf-8')))
+
+            self.send_response(Handler.status)
+            self.send_header('Content-Length', '7')
+            self.end_headers()
+            self.wfile.write(b'refused')
+
+        def log_message(self, *_):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield 'http://127.0.0.1:{}/'.format(server.server_port), Handler, requests
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_caddy_reload_posts_config(cli, caddy_admin):
+    url, _, requests = caddy_admin
+    cli('--caddy-admin', url)
+
+    assert django_run.CaddyBackend().reload('import /etc/caddy/django-run/*.caddy\n')
+    assert requests == [('/load', 'text/caddyfile', 'import /etc/caddy/django-run/*.caddy\n')]
+
+
+def test_caddy_reload_refused(cli, caddy_admin, monkeypatch):
+    url, handler, requests = caddy_admin
+    cli('--caddy-admin', url)
+    monkeypatch.setattr(handler, 'status', 400)
+    monkeypatch.setattr(django_run, 'submit_privileged', lambda change_set: pytest.fail('fell back to the helper'))
+
+    assert not django_run.CaddyBackend().reload('bad')
+    assert len(requests) == 1
+
+
+def test_caddy_reload_falls_back_to_helper(cli, monkeypatch):
+    cli('--caddy-admin', 'http://127.0.0.1:1')
+    submitted = []
+    monkeypatch.setattr(django_run, 'submit_privileged', lambda change_set: submitted.append(change_set) or {})
+
+    assert django_run.CaddyBackend().reload('config')
+    assert submitted == [{'reload': {'backend': 'caddy', 'admin': 'http://127.0.0.1:1'}}]
+
+
+def test_caddy_fragment_without_the_nginx_api(cli, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'nginx', None)
+
+    assert django_run.CaddyBackend().render_fragment('api.local', '127.0.0.2') == 'https://api.local {\n    reverse_proxy 127.0.0.2:8000\n}'
+
+
+def test_caddy_fragment_uses_certificates_only_when_asked(cli, monkeypatch, tmp_path):
+    (tmp_path / 'api.local.pem').write_text('cert')
+    (tmp_path / 'api.local-key.pem').write_text('key')
+    monkeypatch.setattr(django_run, 'CERT_KEY_DEFAULT_PATH', str(tmp_path))
+    monkeypatch.setattr(django_run, '_certificate_index', None)
+
+    assert 'tls' not in django_run.CaddyBackend().render_fragment('api.local', '127.0.0.2')
+
+    django_run.set_setting('caddy_tls', True)
+    assert django_run.CaddyBackend().render_fragment('api.local', '127.0.0.2') == 'https://api.local {{\n    tls {0}/api.local.pem {0}/api.local-key.pem\n    reverse_proxy 127.0.0.2:8000\n}}'.format(tmp_path)
+
+
+def test_proxy_update_reloads_through_the_given_admin(cli, monkeypatch):
+    cli('--caddy-admin', 'http://127.0.0.1:2020')
+    submitted = []
+    monkeypatch.setattr(django_run.CaddyBackend, 'changes', lambda self, hosts, force=False: {'files': [], 'remove': []})
+    monkeypatch.setattr(django_run, 'submit_privileged', submitted.append)
+
+    django_run.update_proxy_config({})
+
+    assert submitted == [{'files': [], 'remove': [], 'reload': {'backend': 'caddy', 'admin': 'http://127.0.0.1:2020'}}]
+
+
+def test_helper_reload_posts_to_the_given_admin(caddy_admin, monkeypatch, tmp_path):
+    url, _, requests = caddy_admin
+    (tmp_path / 'Caddyfile').write_text('import /etc/caddy/django-run/*.caddy\n')
+    monkeypatch.setattr(django_run_helper, 'CADDY_CONFIG_FILE', str(tmp_path / 'Caddyfile'))
+
+    assert django_run_helper.reload_proxy({'backend': 'caddy', 'admin': url}) is None
+    assert requests == [('/load', 'text/caddyfile', 'import /etc/caddy/django-run/*.caddy\n')]
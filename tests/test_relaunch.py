@@ -0,0 +1,20 @@
+import django_run
+
+
+def test_relaunch_keeps_a_single_name_option(cli, monkeypatch, tmp_path):
+    executed = []
+    monkeypatch.setattr(django_run.os, 'chdir', lambda path: None)
+    monkeypatch.setattr(django_run.os, 'execve', lambda path, argv, environ: executed.append(argv[2:]))
+    cli('--relaunch', 'api.local')
+
+    argv = ['--workers', '2', '--name', 'api', '--no-open']
+    for _ in range(3):
+        django_run.record_launch('api.local', str(tmp_path), argv, '/usr/bin/python')
+        django_run.command_relaunch()
+        argv = executed[-1]
+
+    assert argv == ['--workers', '2', '--no-open', '--raw-name', 'api.local']
+
+
+def test_strip_name_options():
+    assert django_run.strip_name_options(['--raw-name', 'a.local', '--name=b', '--raw-name=c', '--celery', '--name', 'd']) == ['--celery']